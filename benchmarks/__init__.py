@@ -0,0 +1,5 @@
+"""
+Нагрузочные замеры компонентов проекта. Запускаются вручную против локальных PostgreSQL/Redis:
+
+    python -m benchmarks.<модуль> --help
+"""
@@ -0,0 +1,82 @@
+"""
+Замер числа принимаемых сообщений чата в секунду на воркер: полный путь TextMessage.ingest (участники и языки
+из кэшей, запись сообщения с отметкой доставки одной транзакцией) в конкурентных гринлетах.
+
+Нужны локальные PostgreSQL и Redis из configs/config.yaml и существующий чат с двумя участниками.
+Сообщения записываются в базу, запускать только на локальной или тестовой базе:
+
+    python -m benchmarks.chat_ingest --chat-id 1 --sender 1 --messages 2000 --greenlets 50
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+from time import perf_counter
+from uuid import uuid4
+
+import gevent
+from flask import Flask, session as flask_session
+
+from resources.chat.model import TextMessage
+
+
+def run(chat_id: int, sender: int, messages: int, greenlets: int) -> dict:
+    """
+    Приём сообщений в конкурентных гринлетах
+
+    :param chat_id: идентификатор чата
+    :param sender: идентификатор отправителя (участник чата)
+    :param messages: общее число сообщений
+    :param greenlets: число конкурентных гринлетов
+    """
+
+    # ключи сообщений уникальны для запуска, иначе повтор замеряет только путь дедупликации
+    nonce = uuid4().hex[:8]
+    app = Flask(__name__)
+    app.secret_key = 'benchmark'
+    latencies = []
+    per_greenlet = max(1, messages // greenlets)
+
+    def worker(n: int):
+        with app.test_request_context():
+            flask_session["from"] = sender
+            for i in range(per_greenlet):
+                started = perf_counter()
+                TextMessage({"chat_id": chat_id,
+                             "text": f"benchmark {n}-{i}",
+                             "extKey": f"bench-{nonce}-{n}-{i}"}).ingest()
+                latencies.append(perf_counter() - started)
+
+    # прогрев кэшей участников и языков, соединений пула
+    gevent.spawn(worker, -1).join()
+    latencies.clear()
+
+    started = perf_counter()
+    gevent.joinall([gevent.spawn(worker, n) for n in range(greenlets)], raise_error=True)
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+
+    return {
+        'messages': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chat-id', type=int, required=True)
+    parser.add_argument('--sender', type=int, required=True)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--greenlets', type=int, default=50)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.chat_id, args.sender, args.messages, args.greenlets)))
+
+
+if __name__ == '__main__':
+    main()
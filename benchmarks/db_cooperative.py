@@ -0,0 +1,82 @@
+"""
+Замер пропускной способности конкурентных запросов к PostgreSQL из гринлетов с кооперативным режимом драйвера
+и без него. Каждый режим запускается в отдельном процессе, так как callback ожидания psycopg2 глобален.
+
+Запуск (нужен локальный PostgreSQL из configs/config.yaml):
+
+    python -m benchmarks.db_cooperative --greenlets 200 --requests 5 --delay 0.05
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import subprocess
+import sys
+from time import perf_counter
+
+import gevent
+from sqlalchemy import text
+
+from configs import configs
+from models.connection import session, DbName
+
+
+def run(greenlets: int, requests: int, delay: float) -> dict:
+    """
+    Нагрузка в текущем процессе: каждый гринлет выполняет серию запросов с задержкой на стороне сервера
+
+    :param greenlets: число конкурентных гринлетов
+    :param requests: число запросов на гринлет
+    :param delay: длительность одного запроса на стороне PostgreSQL, сек
+    """
+
+    latencies = []
+
+    def worker():
+        for _ in range(requests):
+            started = perf_counter()
+            with session(DbName.REXPAT) as ses:
+                ses.execute(text('SELECT pg_sleep(:delay)'), {'delay': delay})
+            latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+    gevent.joinall([gevent.spawn(worker) for _ in range(greenlets)], raise_error=True)
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+
+    return {
+        'cooperative': bool(configs['postgres'].get('cooperative')),
+        'queries': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_qps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--greenlets', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5)
+    parser.add_argument('--delay', type=float, default=0.05)
+    parser.add_argument('--mode', choices=('on', 'off'), help='запуск одного режима в текущем процессе')
+    args = parser.parse_args()
+
+    if args.mode:
+        configs['postgres']['cooperative'] = args.mode == 'on'
+        print(json.dumps(run(args.greenlets, args.requests, args.delay)))
+        return
+
+    for mode in ('off', 'on'):
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.db_cooperative', '--mode', mode,
+                              '--greenlets', str(args.greenlets),
+                              '--requests', str(args.requests),
+                              '--delay', str(args.delay)],
+                             check=True, capture_output=True, text=True).stdout
+        print(out.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main()
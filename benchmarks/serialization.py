@@ -0,0 +1,91 @@
+"""
+Сравнение JSON и msgpack для данных событий чата: время кодирования и размер на одно событие.
+
+Данные повторяют TextMessage.to_dict (сообщение) и ActionMessage.to_dict при LOAD_CHATS (список чатов).
+Не требует конфигурации и сервисов:
+
+    python -m benchmarks.serialization --chats 50 --iterations 20000
+"""
+import argparse
+import json
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import msgpack
+
+
+def message_payload() -> dict:
+    return {
+        "sender": 10452,
+        "chat_id": 8812,
+        "type": "message",
+        "message_id": 1048576,
+        "timestamp": 1718000000,
+        "time": "12:41",
+        "text": "Здравствуйте! Квартира ещё свободна? Можно посмотреть в субботу после обеда?",
+        "translated": "Hello! Is the apartment still available? Can I see it on Saturday afternoon?",
+    }
+
+
+def chats_payload(chats: int) -> dict:
+    started = datetime(2024, 6, 10, 12, 0)
+    return {
+        "sender": 10452,
+        "type": "action",
+        "action": "load_chats",
+        "unseen_counter": 17,
+        "chats": [{
+            "chat_id": 8800 + i,
+            "entity_id": 55000 + i,
+            "user_id": 20000 + i,
+            "name": f"Пользователь {i}",
+            "photo": f"https://storage.example.com/avatars/{20000 + i}.jpg",
+            "online": i % 3 == 0,
+            "subject": f"Сдаётся 2-комнатная квартира, {40 + i} м²",
+            "price": 1500 + i * 10,
+            "currency": "USD",
+            "last_message": "Добрый день, договорились, до встречи",
+            "last_message_time": (started - timedelta(minutes=i * 7)).isoformat(),
+            "unseen": i % 4,
+        } for i in range(chats)],
+    }
+
+
+def measure(encode, payload: dict, iterations: int) -> dict:
+    encoded = encode(payload)
+    started = perf_counter()
+    for _ in range(iterations):
+        encode(payload)
+    elapsed = perf_counter() - started
+
+    return {"bytes": len(encoded), "encode_us": round(elapsed / iterations * 1e6, 2)}
+
+
+def run(chats: int, iterations: int) -> dict:
+    # пакет Socket.IO кодируется json.dumps с компактными разделителями, msgpack уходит бинарным вложением
+    encoders = {
+        "json": lambda payload: json.dumps(payload, separators=(',', ':')).encode(),
+        "msgpack": lambda payload: msgpack.packb(payload, use_bin_type=True, default=str),
+    }
+    payloads = {"message": message_payload(), "chats": chats_payload(chats)}
+
+    result = {}
+    for name, payload in payloads.items():
+        result[name] = {fmt: measure(encode, payload, iterations) for fmt, encode in encoders.items()}
+        sizes = {fmt: item["bytes"] for fmt, item in result[name].items()}
+        result[name]["msgpack_size_ratio"] = round(sizes["msgpack"] / sizes["json"], 3)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.chats, args.iterations)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Проверка доставки сообщений чата между узлами Socket.IO через очередь сообщений Redis.
+
+Запускаются два процесса сервера на разных портах, отправитель подключается к первому, получатель ко второму.
+Проверяется, что сообщение доходит до получателя на другом узле, а подтверждение доставки возвращается
+отправителю. Нужны локальные PostgreSQL и Redis из configs/config.yaml с включённым socket_io.message_queue,
+незаблокированные пользователи и существующий чат между ними. Сообщения записываются в базу:
+
+    python -m benchmarks.socket_cluster --chat-id 1 --sender 1 --receiver 2
+"""
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import threading
+from time import monotonic, sleep
+from uuid import uuid4
+
+
+def serve(port: int):
+    """
+    Процесс сервера: приложение с сокетом на указанном порту
+    """
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    from main.app import create_app, socket_io
+
+    socket_io.run(create_app(), host='127.0.0.1', port=port, allow_unsafe_werkzeug=True)
+
+
+def wait_port(port: int, timeout: float):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        sleep(0.2)
+    raise TimeoutError(f"Server on port {port} did not start in {timeout} s")
+
+
+def make_token(user_id) -> str:
+    """
+    Токен доступа пользователя, подписанный ключом приложения
+    """
+
+    from flask_jwt_extended import create_access_token
+    from main.app import create_app
+
+    with create_app().app_context():
+        return create_access_token(identity=user_id)
+
+
+def connect(port: int, user_id):
+    import socketio
+
+    client = socketio.Client(reconnection=False)
+    client.received = []
+    client.event_ready = threading.Event()
+
+    @client.on('message')
+    def on_message(data):
+        client.received.append(('message', data))
+        client.event_ready.set()
+
+    @client.on('action')
+    def on_action(data):
+        client.received.append(('action', data))
+        client.event_ready.set()
+
+    client.connect(f'http://127.0.0.1:{port}',
+                   headers={'Authorization': f'Bearer {make_token(user_id)}', 'client': f'cluster-{port}'},
+                   transports=['websocket'],
+                   wait_timeout=10)
+
+    return client
+
+
+def wait_for(client, predicate, timeout: float):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if any(predicate(event, data) for event, data in client.received):
+            return True
+        client.event_ready.wait(0.1)
+        client.event_ready.clear()
+    return False
+
+
+def check(chat_id: int, sender: int, receiver: int, ports: tuple, timeout: float) -> dict:
+    """
+    Отправка сообщения в обе стороны между клиентами, подключёнными к разным узлам
+    """
+
+    servers = [subprocess.Popen([sys.executable, '-m', 'benchmarks.socket_cluster', '--serve', str(port)])
+               for port in ports]
+
+    try:
+        for port in ports:
+            wait_port(port, timeout)
+
+        clients = {sender: connect(ports[0], sender), receiver: connect(ports[1], receiver)}
+        # вход сокетов в комнаты пользователей
+        sleep(0.5)
+
+        result = {}
+        for source, target in ((sender, receiver), (receiver, sender)):
+            text = f"cluster check {uuid4()}"
+            started = monotonic()
+            clients[source].emit('message', {"chat_id": chat_id, "text": text, "extKey": str(uuid4())})
+
+            delivered = wait_for(clients[target],
+                                 lambda event, data: event == 'message' and data.get("text") == text, timeout)
+            acknowledged = wait_for(clients[source],
+                                    lambda event, data: event == 'action' and data.get("action") == "delivered",
+                                    timeout)
+            result[f"{source}->{target}"] = {"delivered": delivered,
+                                             "acknowledged": acknowledged,
+                                             "latency_ms": round((monotonic() - started) * 1000, 2)}
+            clients[source].received.clear()
+            clients[target].received.clear()
+
+        for client in clients.values():
+            client.disconnect()
+
+        return result
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--chat-id', type=int)
+    parser.add_argument('--sender', type=int)
+    parser.add_argument('--receiver', type=int)
+    parser.add_argument('--ports', type=int, nargs=2, default=(5101, 5102))
+    parser.add_argument('--timeout', type=float, default=15)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    if None in (args.chat_id, args.sender, args.receiver):
+        parser.error("--chat-id, --sender and --receiver are required")
+
+    result = check(args.chat_id, args.sender, args.receiver, tuple(args.ports), args.timeout)
+    print(json.dumps(result))
+
+    if not all(item["delivered"] and item["acknowledged"] for item in result.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
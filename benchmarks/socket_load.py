@@ -0,0 +1,265 @@
+"""
+Нагрузочный тест пространства имён чата: один процесс сервера и N клиентов python-socketio.
+
+Клиенты подключаются с токенами доступа, подписанными ключом main/rs256.pem, обмениваются сообщениями в
+заданных чатах, отправляют события набора текста и просмотра, затем отключаются. Результат: задержка
+подключения, задержка доставки сообщений p50/p99 и процессорное время сервера на одно сообщение
+(по /proc/<pid>/stat). Нужны локальные PostgreSQL и Redis из configs/config.yaml, незаблокированные
+пользователи и чаты между ними (chat_id:user_id:user_id). Сообщения записываются в базу:
+
+    python -m benchmarks.socket_load --chat 1:1:2 --chat 2:3:4 --clients 100 --messages 20
+
+Результат можно сохранить в файл (--output) и сравнивать между сборками.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+from time import monotonic, perf_counter, sleep
+from uuid import uuid4
+
+import jwt
+import socketio
+
+from benchmarks.socket_cluster import wait_port
+
+
+MARKER = "socket-load"
+
+
+def make_token(private_key: bytes, user_id) -> str:
+    """
+    Токен доступа в формате flask_jwt_extended
+    """
+
+    now = datetime.now(timezone.utc)
+    claims = {
+        "fresh": False,
+        "iat": now,
+        "jti": str(uuid4()),
+        "type": "access",
+        "sub": user_id,
+        "nbf": now,
+        "exp": now + timedelta(hours=1),
+    }
+
+    return jwt.encode(claims, private_key, algorithm="RS256")
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    Процессорное время процесса (user + system)
+    """
+
+    with open(f"/proc/{pid}/stat") as stat:
+        # имя процесса может содержать пробелы, поля считаются после закрывающей скобки
+        fields = stat.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * share))] * 1000, 2)
+
+
+class DeliveryTracker:
+    """
+    Первая доставка каждого сообщения сокету получателя. Копии на другие сокеты того же пользователя
+    и на другие устройства отправителя не учитываются
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__sent = {}
+        self.__delivered = {}
+
+    def sent(self, key: str):
+        with self.__lock:
+            self.__sent[key] = perf_counter()
+
+    def delivered(self, key: str) -> bool:
+        """
+        Учёт доставки, True для первой доставки сообщения
+        """
+        now = perf_counter()
+        with self.__lock:
+            if key in self.__delivered or key not in self.__sent:
+                return False
+            self.__delivered[key] = now - self.__sent[key]
+            return True
+
+    @property
+    def pending(self) -> int:
+        with self.__lock:
+            return len(self.__sent) - len(self.__delivered)
+
+    @property
+    def latencies(self) -> list:
+        with self.__lock:
+            return list(self.__delivered.values())
+
+
+class LoadClient:
+    """
+    Клиент чата: подключение, отправка сообщений и действий, учёт задержек доставки
+    """
+
+    def __init__(self, number: int, url: str, token: str, user_id: int, chat_id: int, tracker: DeliveryTracker):
+        self.number = number
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.connect_latency = None
+        self.__url = url
+        self.__token = token
+        self.__tracker = tracker
+        self.__client = socketio.Client(reconnection=False)
+        self.__client.on("message", self.__on_message)
+
+    def __on_message(self, data: dict):
+        text = data.get("text") or ""
+        if not text.startswith(MARKER) or str(data.get("sender")) == str(self.user_id):
+            # копия собственного сообщения на другом устройстве отправителя
+            return
+
+        if self.__tracker.delivered(text.split("|")[1]) and data.get("message_id"):
+            # просмотр отмечается один раз на сообщение
+            self.__client.emit("action", {"action": "viewed",
+                                          "chat_id": data.get("chat_id"),
+                                          "message_id": data.get("message_id")})
+
+    def connect(self):
+        started = perf_counter()
+        self.__client.connect(self.__url,
+                              headers={"Authorization": f"Bearer {self.__token}", "client": f"load-{self.number}"},
+                              transports=["websocket"],
+                              wait_timeout=30)
+        self.connect_latency = perf_counter() - started
+
+    def run(self, messages: int, pause: float):
+        for i in range(messages):
+            self.__client.emit("action", {"action": "typing", "chat_id": self.chat_id})
+            key = f"{self.number}-{i}"
+            self.__tracker.sent(key)
+            self.__client.emit("message", {"chat_id": self.chat_id,
+                                           "text": f"{MARKER}|{key}",
+                                           "extKey": str(uuid4())})
+            sleep(pause)
+        self.__client.emit("action", {"action": "stop_typing", "chat_id": self.chat_id})
+
+    def disconnect(self):
+        self.__client.disconnect()
+
+
+def run(chats: list, clients: int, messages: int, pause: float, port: int, drain: float) -> dict:
+    """
+    Запуск сервера и нагрузки
+
+    :param chats: чаты (chat_id, user_id, user_id)
+    :param clients: число клиентов, распределяются по участникам чатов по кругу
+    :param messages: число сообщений от каждого клиента
+    :param pause: пауза между сообщениями клиента, сек
+    :param port: порт сервера
+    :param drain: время ожидания доставки после отправки, сек
+    """
+
+    with open(os.path.join(".", "main", "rs256.pem"), mode="rb") as private:
+        private_key = private.read()
+
+    tracker = DeliveryTracker()
+    members = [(chat_id, user_id) for chat_id, *users in chats for user_id in users]
+    load_clients = []
+    for number in range(clients):
+        chat_id, user_id = members[number % len(members)]
+        load_clients.append(LoadClient(number, f"http://127.0.0.1:{port}", make_token(private_key, user_id),
+                                       user_id, chat_id, tracker))
+
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.socket_cluster", "--serve", str(port)])
+
+    try:
+        wait_port(port, 30)
+
+        threads = [threading.Thread(target=client.connect) for client in load_clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        connected = [client for client in load_clients if client.connect_latency is not None]
+        cpu_started = cpu_seconds(server.pid)
+        started = monotonic()
+
+        threads = [threading.Thread(target=client.run, args=(messages, pause)) for client in connected]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sent = len(connected) * messages
+        # ожидание первой доставки каждого отправленного сообщения
+        deadline = monotonic() + drain
+        while monotonic() < deadline and tracker.pending:
+            sleep(0.1)
+
+        elapsed = monotonic() - started
+        cpu = cpu_seconds(server.pid) - cpu_started
+
+        for client in connected:
+            client.disconnect()
+    finally:
+        server.terminate()
+        server.wait()
+
+    connect = [client.connect_latency for client in connected]
+    delivery = tracker.latencies
+
+    return {
+        "clients": clients,
+        "connect_failed": clients - len(connected),
+        "messages_sent": sent,
+        "delivered": len(delivery),
+        "undelivered": sent - len(delivery),
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(sent / elapsed, 1),
+        "connect_p50_ms": percentile(connect, 0.5),
+        "connect_p99_ms": percentile(connect, 0.99),
+        "delivery_p50_ms": percentile(delivery, 0.5),
+        "delivery_p99_ms": percentile(delivery, 0.99),
+        "server_cpu_s": round(cpu, 3),
+        "server_cpu_ms_per_message": round(cpu / sent * 1000, 3) if sent else 0.0,
+    }
+
+
+def parse_chat(value: str) -> tuple:
+    chat_id, *users = (int(item) for item in value.split(":"))
+    if len(users) < 2:
+        raise argparse.ArgumentTypeError("expected chat_id:user_id:user_id")
+    return (chat_id, *users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chat", type=parse_chat, action="append", required=True)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--pause", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=5111)
+    parser.add_argument("--drain", type=float, default=10)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    result = run(args.chat, args.clients, args.messages, args.pause, args.port, args.drain)
+    print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, mode="a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,8 @@ from webargs.flaskparser import parser
 
 from configs import configs
 from main.cache import CACHE
+from models.connection import get_redis_pool
+from models.instrumentation import start_tracking, finish_tracking
 from resources import PublicAPI
 from resources.chat import socket_io
 from services.auth.enums import Timing
@@ -53,6 +55,10 @@ def create_app():
     app.config['CACHE_REDIS_PASSWORD'] = configs.get('redis').get('password')
     app.config['CACHE_REDIS_DB'] = configs.get('redis').get('cache_db')
     app.config['CACHE_DEFAULT_TIMEOUT'] = SECONDS_PER_DAY
+    # кэш хранит сериализованные объекты, поэтому использует отдельный пул без декодирования ответов
+    app.config['CACHE_OPTIONS'] = {
+        'connection_pool': get_redis_pool(configs.get('redis').get('cache_db'), decode_responses=False)
+    }
 
     CACHE.init_app(app)
     CACHE.clear()
@@ -111,6 +117,13 @@ def create_app():
         token_in_redis = REDIS_BLOCK_LIST.get(jti)
         return token_in_redis is not None
 
+    @app.before_request
+    def track_sql_queries():
+        # учёт SQL запросов в разрезе эндпоинтов
+        start_tracking(f"{request.method} {request.endpoint}")
+
+    app.teardown_request(finish_tracking)
+
     @app.after_request
     @jwt_required(optional=True)
     def refresh_token(response):
@@ -37,5 +37,9 @@ celery_app.conf.beat_schedule = {
     'add_to_archive': {
         'task': 'services.announcement.tasks.add_to_archive',
         'schedule': crontab(hour=3, minute=0)
+    },
+    'sync chat presence': {
+        'task': 'services.chat.tasks.sync_presence_task',
+        'schedule': 60,
     }
 }
@@ -14,7 +14,7 @@ result_backend = broker_url
 
 timezone = 'Europe/Moscow'  # pylint: disable=invalid-name
 
-imports = ("services.currencies.tasks", "services.announcement.tasks")
+imports = ("services.currencies.tasks", "services.announcement.tasks", "services.chat.tasks")
 
 # пути к задачам
 task_routes = {
@@ -24,4 +24,7 @@ task_routes = {
     'services.announcement.tasks.add_to_archive': {
         'queue': f'beat_queue{"_release" if configs.get("mode") == "release" else ""}'
     },
+    'services.chat.tasks.sync_presence_task': {
+        'queue': f'beat_queue{"_release" if configs.get("mode") == "release" else ""}'
+    },
 }
@@ -2,27 +2,75 @@
 Модуль подклчения к базе данных
 """
 
+import os
+
 from functools import wraps
 from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple, Optional, List
 
 from urllib.parse import quote
 
-from redis import StrictRedis
-from sqlalchemy import create_engine
+from gevent.socket import wait_read, wait_write
+from psycopg2 import extensions, OperationalError
+from redis import StrictRedis, BlockingConnectionPool
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import Engine
 
 from sqlalchemy.orm import sessionmaker
 
 from configs import configs
+from logger import get_logger
 from main.celery_config import broker_url
 
 from .enums import DbName
+from .instrumentation import instrument_engine
+
+
+# настройки пула соединений по умолчанию, переопределяются секцией postgres конфигурационного файла
+POOL_DEFAULTS = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_recycle': 1800,
+    'pool_timeout': 30,
+    'pool_pre_ping': True,
+}
+
+# в кооперативном режиме пул рассчитан на конкуренцию гринлетов воркера: соединения ограничены размером пула,
+# остальные гринлеты ожидают освобождения соединения, не блокируя цикл событий
+COOPERATIVE_POOL_DEFAULTS = {
+    'cooperative_pool_size': 50,
+    'cooperative_max_overflow': 50,
+}
+
+# настройки пулов соединений Redis по умолчанию, переопределяются секцией redis конфигурационного файла
+REDIS_POOL_DEFAULTS = {
+    'max_connections': 100,
+    'timeout': 5,
+    'health_check_interval': 30,
+    'socket_timeout': 5,
+    'socket_connect_timeout': 5,
+}
+
+# время исключения реплики из балансировки после ошибки подключения, сек
+REPLICA_EJECTION_DEFAULT = 30
+
+LOGGER = get_logger("DbConnection", "DbConnection")
+
+# реестр движков и фабрик сессий процесса:
+# (имя базы, реплика или None для основного сервера) -> (pid процесса-владельца, движок, фабрика сессий)
+_ENGINES: Dict[Tuple[DbName, Optional[str]], Tuple[int, Engine, sessionmaker]] = {}
+_ENGINES_LOCK = Lock()
 
 
-def make_engine(db_name: DbName):
+def get_engine_string(db_name: DbName, replica: str = None) -> str:
     """
-    Создание движка БД
+    Строка подключения к базе данных
 
     :param db_name: название базы
+    :param replica: адрес реплики в виде host[:port], по умолчанию основной сервер
     """
 
     pg_config = configs.get('postgres')
@@ -30,49 +78,236 @@ def make_engine(db_name: DbName):
     user = pg_config.get('username')
     host = pg_config.get('host')
     port = pg_config.get('port')
-    hostname = f'{host}:{port}' if port else host
-    engine_string = f'postgresql://{user}:{password}@{hostname}/{db_name.value}'
-    engine = create_engine(engine_string)
+    hostname = replica or (f'{host}:{port}' if port else host)
+
+    return f'postgresql://{user}:{password}@{hostname}/{db_name.value}'
+
+
+def get_pool_options() -> dict:
+    """
+    Параметры пула соединений с учётом конфигурационного файла
+    """
+
+    pg_config = configs.get('postgres')
+
+    options = dict(POOL_DEFAULTS)
+    options.update({k: v for k, v in pg_config.items() if k in POOL_DEFAULTS and v is not None})
+
+    if is_cooperative():
+        for option, default in COOPERATIVE_POOL_DEFAULTS.items():
+            value = pg_config.get(option)
+            options[option.removeprefix('cooperative_')] = default if value is None else value
+
+    return options
+
+
+def is_cooperative() -> bool:
+    """
+    Включён ли кооперативный (совместимый с gevent) режим драйвера PostgreSQL
+    """
+
+    return bool(configs.get('postgres').get('cooperative'))
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """
+    Ожидание готовности соединения psycopg2 через цикл событий gevent: на время сетевого ввода-вывода
+    управление передаётся другим гринлетам вместо блокировки всего воркера
+
+    :param conn: соединение psycopg2
+    :param timeout: время ожидания готовности сокета
+    """
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        if state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f'Bad result from poll: {state!r}')
+
+
+def set_cooperative_mode(enabled: bool = True):
+    """
+    Установка (или снятие) callback ожидания psycopg2. Действует на соединения, открытые после вызова
+
+    :param enabled: включить кооперативный режим
+    """
+
+    extensions.set_wait_callback(gevent_wait_callback if enabled else None)
+
+
+def make_engine(db_name: DbName, replica: str = None) -> Engine:
+    """
+    Создание движка БД
+
+    :param db_name: название базы
+    :param replica: адрес реплики, по умолчанию основной сервер
+    """
+
+    engine = create_engine(get_engine_string(db_name, replica), **get_pool_options())
+    instrument_engine(engine)
 
     return engine
 
 
-def make_session(db_name: DbName):
+def _registry_entry(db_name: DbName, replica: str = None) -> Tuple[int, Engine, sessionmaker]:
+    """
+    Запись реестра для текущего процесса. Движок, унаследованный от родительского процесса (fork uWSGI),
+    освобождается без закрытия соединений родителя и создаётся заново
+
+    :param db_name: имя базы данных
+    :param replica: адрес реплики, по умолчанию основной сервер
+    """
+
+    pid = os.getpid()
+    key = (db_name, replica)
+    entry = _ENGINES.get(key)
+
+    if entry and entry[0] == pid:
+        return entry
+
+    with _ENGINES_LOCK:
+        entry = _ENGINES.get(key)
+        if entry and entry[0] == pid:
+            return entry
+
+        if entry:
+            # соединения родителя не закрываются, а только забываются пулом
+            entry[1].dispose(close=False)
+
+        if is_cooperative():
+            set_cooperative_mode()
+
+        engine = make_engine(db_name, replica)
+        entry = _ENGINES[key] = (pid, engine, sessionmaker(bind=engine))
+
+    return entry
+
+
+def get_engine(db_name: DbName = DbName.REXPAT) -> Engine:
+    """
+    Движок БД из реестра процесса
+
+    :param db_name: имя базы данных
+    """
+
+    return _registry_entry(db_name)[1]
+
+
+def dispose_engines():
     """
-    Создание класса сессии
+    Освобождение всех движков процесса. Вызывается после fork воркера uWSGI
+    """
+
+    with _ENGINES_LOCK:
+        for _, engine, _ in _ENGINES.values():
+            engine.dispose(close=False)
+        _ENGINES.clear()
+
+
+class ReplicaRouter:
+    """
+    Балансировка читающих сессий между репликами по кругу. Реплика, к которой не удалось подключиться,
+    исключается из балансировки на время ejection, при недоступности всех реплик используется основной сервер
+    """
+
+    def __init__(self):
+        self.__counter = count()
+        self.__ejected: Dict[str, float] = {}
+
+    @property
+    def replicas(self) -> List[str]:
+        replicas = configs.get('postgres').get('replicas') or []
+        return [f'{r["host"]}:{r["port"]}' if r.get('port') else r['host'] for r in replicas if r.get('host')]
+
+    @property
+    def ejection(self) -> float:
+        return configs.get('postgres').get('replica_ejection') or REPLICA_EJECTION_DEFAULT
+
+    def candidates(self) -> List[str]:
+        """
+        Доступные реплики, начиная с очередной по кругу
+        """
+
+        now = monotonic()
+        healthy = [r for r in self.replicas if self.__ejected.get(r, 0) <= now]
+
+        if not healthy:
+            return []
+
+        start = next(self.__counter) % len(healthy)
+
+        return healthy[start:] + healthy[:start]
+
+    def eject(self, replica: str):
+        """
+        Исключение реплики из балансировки
+
+        :param replica: адрес реплики
+        """
+
+        self.__ejected[replica] = monotonic() + self.ejection
+
+
+REPLICAS = ReplicaRouter()
+
+
+def make_session(db_name: DbName, readonly: bool = False):
+    """
+    Создание объекта сессии
 
     :param db_name: имя базы данных
+    :param readonly: сессия только для чтения, направляется на реплику
     """
 
-    return sessionmaker(bind=make_engine(db_name))()
+    if readonly:
+        for replica in REPLICAS.candidates():
+            ses = _registry_entry(db_name, replica)[2]()
+            try:
+                # проверка доступности реплики при получении соединения из пула
+                ses.connection()
+            except exc.OperationalError as error:
+                ses.close()
+                REPLICAS.eject(replica)
+                LOGGER.error("Replica %s ejected: %s", replica, error)
+            else:
+                return ses
+
+    return _registry_entry(db_name)[2]()
 
 
 @contextmanager
-def session(db_name: DbName = DbName.REXPAT):
+def session(db_name: DbName = DbName.REXPAT, readonly: bool = False):
     """
     Контекстный менеджер для работы с сессией БД\
 
     :param db_name: имя базы данных
+    :param readonly: сессия только для чтения, направляется на реплику
     """
 
-    ses = make_session(db_name)
+    ses = make_session(db_name, readonly)
     try:
         yield ses
     finally:
         ses.close()
 
 
-def with_session(db_name: DbName = DbName.REXPAT):
+def with_session(db_name: DbName = DbName.REXPAT, readonly: bool = False):
     """
     Декоратор с параметром для предоставления функциям объякта сессии для взаимодействия с базой данных
 
     :param db_name: имя базы данных для подключения
+    :param readonly: сессия только для чтения, направляется на реплику
     """
 
     def with_session_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            sql_session = make_session(db_name)
+            sql_session = make_session(db_name, readonly)
             try:
                 res = func(sql_session, *args, **kwargs)
             finally:
@@ -84,17 +319,91 @@ def with_session(db_name: DbName = DbName.REXPAT):
     return with_session_decorator
 
 
-def get_redis_client(db: int = None) -> StrictRedis:
+# реестр пулов соединений Redis процесса: (номер базы, декодирование ответов) -> пул
+_REDIS_POOLS: Dict[Tuple[int, bool], BlockingConnectionPool] = {}
+_REDIS_CLIENTS: Dict[int, StrictRedis] = {}
+_REDIS_LOCK = Lock()
+
+
+def get_redis_pool(db: int = None, decode_responses: bool = True) -> BlockingConnectionPool:
+    """
+    Общий пул соединений логической базы Redis (token_db, verification_db, socket_db, cache_db, брокер).
+    При исчерпании пула клиент ожидает освобождения соединения не дольше timeout.
+    Пул сам пересоздаёт соединения в процессе-потомке после fork
+
+    :param db: номер базы, по умолчанию база брокера
+    :param decode_responses: декодировать ответы в строки
+    """
+
     REDIS = configs.get('redis')
+    db = db or REDIS['db']
+    key = (db, decode_responses)
 
-    return StrictRedis(host=REDIS['host'],
-                       port=REDIS['port'],
-                       db=db or REDIS['db'],
-                       password=REDIS['password'],
-                       decode_responses=True)
+    if pool := _REDIS_POOLS.get(key):
+        return pool
+
+    with _REDIS_LOCK:
+        if pool := _REDIS_POOLS.get(key):
+            return pool
+
+        options = dict(REDIS_POOL_DEFAULTS)
+        options.update({k: v for k, v in REDIS.items() if k in REDIS_POOL_DEFAULTS and v is not None})
+
+        pool = _REDIS_POOLS[key] = BlockingConnectionPool(host=REDIS['host'],
+                                                          port=REDIS['port'],
+                                                          db=db,
+                                                          password=REDIS['password'],
+                                                          decode_responses=decode_responses,
+                                                          **options)
+
+    return pool
+
+
+def get_redis_client(db: int = None) -> StrictRedis:
+    """
+    Клиент Redis поверх общего пула соединений базы
+
+    :param db: номер базы, по умолчанию база брокера
+    """
+
+    db = db or configs.get('redis')['db']
+
+    if (client := _REDIS_CLIENTS.get(db)) is None:
+        client = _REDIS_CLIENTS[db] = StrictRedis(connection_pool=get_redis_pool(db))
+
+    return client
+
+
+def redis_pool_stats() -> list:
+    """
+    Состояние пулов соединений Redis процесса
+    """
+
+    stats = []
+    for (db, decode_responses), pool in list(_REDIS_POOLS.items()):
+        idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        created = len(pool._connections)  # pylint: disable=protected-access
+        stats.append({"db": db,
+                      "decode_responses": decode_responses,
+                      "max_connections": pool.max_connections,
+                      "created": created,
+                      "idle": idle,
+                      "in_use": created - idle})
+
+    return stats
 
 
 def get_redis_connection_url(db: int = None) -> str:
     REDIS = configs.get('redis')
     pw_string = f':{REDIS["password"]}@' if REDIS["password"] else ''
     return f'redis://{pw_string}{REDIS["host"]}:{REDIS["port"]}/{db or REDIS["db"]}'
+
+
+try:
+    # под uWSGI движки освобождаются сразу после fork воркера. Пулы Redis не сбрасываются: на них ссылаются
+    # модульные объекты, загруженные до fork, а соединения пул сам пересоздаёт по смене pid
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    postfork(dispose_engines)
@@ -0,0 +1,215 @@
+"""
+Модуль учёта SQL запросов: число запросов, суммарное время и самые медленные запросы на каждый HTTP запрос
+или событие сокета, выявление повторяющихся запросов (N+1)
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Optional, List, Tuple, Dict
+
+import sentry_sdk
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from configs import configs
+from logger import get_logger
+
+
+LOGGER = get_logger("SqlStats", "SqlStats")
+
+# число повторений одного запроса, начиная с которого он считается признаком N+1
+N_PLUS_ONE_DEFAULT = 5
+# порог медленного запроса, мс
+SLOW_QUERY_DEFAULT = 200
+# число сохраняемых самых медленных запросов
+SLOWEST_LIMIT = 3
+
+_CURRENT: ContextVar[Optional['QueryStats']] = ContextVar('sql_query_stats', default=None)
+
+
+class QueryStats:
+    """
+    Статистика запросов одной единицы работы (HTTP запрос, событие сокета)
+    """
+
+    __slots__ = ("name", "count", "duration", "statements", "slowest")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self.slowest: List[Tuple[float, str]] = []
+
+    def add(self, statement: str, duration: float):
+        """
+        Учёт выполненного запроса
+
+        :param statement: текст запроса (с плейсхолдерами параметров)
+        :param duration: длительность, сек
+        """
+
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+        if len(self.slowest) < SLOWEST_LIMIT or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, statement))
+            self.slowest.sort(key=lambda x: x[0], reverse=True)
+            del self.slowest[SLOWEST_LIMIT:]
+
+    def repeated(self) -> List[Tuple[str, int]]:
+        """
+        Запросы, повторённые не меньше порога N+1
+        """
+
+        threshold = configs.get('postgres').get('n_plus_one_threshold') or N_PLUS_ONE_DEFAULT
+
+        return [(statement, n) for statement, n in self.statements.most_common() if n >= threshold]
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "query_count": self.count,
+            "db_time_ms": round(self.duration * 1000, 2),
+            "slowest": [{"ms": round(d * 1000, 2), "statement": s} for d, s in self.slowest],
+            "n_plus_one": [{"count": n, "statement": s} for s, n in self.repeated()],
+        }
+
+
+class QueryStatsAggregate:
+    """
+    Накопленная статистика процесса в разрезе эндпоинтов и событий сокета
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__data: Dict[str, dict] = {}
+
+    def add(self, stats: QueryStats, n_plus_one: bool):
+        with self.__lock:
+            item = self.__data.setdefault(stats.name, {"calls": 0,
+                                                       "queries": 0,
+                                                       "db_time_ms": 0.0,
+                                                       "max_queries": 0,
+                                                       "max_db_time_ms": 0.0,
+                                                       "n_plus_one_calls": 0})
+            duration_ms = stats.duration * 1000
+            item["calls"] += 1
+            item["queries"] += stats.count
+            item["db_time_ms"] += duration_ms
+            item["max_queries"] = max(item["max_queries"], stats.count)
+            item["max_db_time_ms"] = max(item["max_db_time_ms"], duration_ms)
+            item["n_plus_one_calls"] += int(n_plus_one)
+
+    def to_list(self) -> List[dict]:
+        with self.__lock:
+            data = [{"name": name, **item} for name, item in self.__data.items()]
+
+        for item in data:
+            item["avg_queries"] = round(item["queries"] / item["calls"], 2)
+            item["avg_db_time_ms"] = round(item["db_time_ms"] / item["calls"], 2)
+            item["db_time_ms"] = round(item["db_time_ms"], 2)
+            item["max_db_time_ms"] = round(item["max_db_time_ms"], 2)
+
+        return sorted(data, key=lambda x: x["db_time_ms"], reverse=True)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+
+AGGREGATE = QueryStatsAggregate()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start_time'].pop()
+    stats = _CURRENT.get()
+
+    if stats is not None:
+        stats.add(statement, perf_counter() - started)
+
+
+def instrument_engine(engine: Engine):
+    """
+    Подключение обработчиков учёта запросов к движку
+
+    :param engine: движок БД
+    """
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def start_tracking(name: str):
+    """
+    Начало учёта запросов для текущего контекста (гринлета)
+
+    :param name: имя эндпоинта или события
+    """
+
+    _CURRENT.set(QueryStats(name))
+
+
+def finish_tracking(*_args):
+    """
+    Завершение учёта запросов текущего контекста с записью результатов в лог, Sentry и накопленную статистику
+    """
+
+    stats = _CURRENT.get()
+
+    if stats is None:
+        return
+
+    _CURRENT.set(None)
+    report(stats)
+
+
+@contextmanager
+def track_queries(name: str):
+    """
+    Контекстный менеджер учёта запросов
+
+    :param name: имя эндпоинта или события
+    """
+
+    token = _CURRENT.set(stats := QueryStats(name))
+    try:
+        yield stats
+    finally:
+        _CURRENT.reset(token)
+        report(stats)
+
+
+def report(stats: QueryStats):
+    """
+    Публикация статистики единицы работы
+
+    :param stats: статистика запросов
+    """
+
+    data = stats.to_dict()
+    slow_ms = configs.get('postgres').get('slow_query_ms') or SLOW_QUERY_DEFAULT
+
+    if data["n_plus_one"]:
+        LOGGER.warning("%s: possible N+1, %s queries in %s ms: %s",
+                       stats.name, stats.count, data["db_time_ms"], data["n_plus_one"])
+
+    if stats.slowest and stats.slowest[0][0] * 1000 >= slow_ms:
+        LOGGER.warning("%s: slow queries: %s", stats.name, data["slowest"])
+
+    if stats.count:
+        sentry_sdk.set_context("sql", data)
+        if span := sentry_sdk.Hub.current.scope.span:
+            span.set_data("db.query_count", stats.count)
+            span.set_data("db.time_ms", data["db_time_ms"])
+            span.set_data("db.n_plus_one", bool(data["n_plus_one"]))
+
+    AGGREGATE.add(stats, bool(data["n_plus_one"]))
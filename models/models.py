@@ -144,6 +144,42 @@ class UserXChat(Base):
     chat_id = db.Column(db.Integer, db.ForeignKey("chat.chats.id"), primary_key=True)
 
 
+class ChatMessage(Base):
+    """
+    Сообщения чатов
+    """
+
+    __table_args__ = (db.UniqueConstraint("sender", "ext_key", name="uq_chat_messages_sender_ext_key"),
+                      # постраничная загрузка истории чата по ключу (chat_id, id)
+                      db.Index("ix_chat_messages_chat_id_id", "chat_id", "id"),
+                      {'schema': 'chat'})
+    __tablename__ = 'messages'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    chat_id = db.Column(db.Integer, db.ForeignKey("chat.chats.id"), nullable=False)
+    sender = db.Column(db.Integer, db.ForeignKey("main.users.user_id"))
+    receiver = db.Column(db.Integer, db.ForeignKey("main.users.user_id"))
+    text = db.Column(db.String)
+    timestamp = db.Column(db.TIMESTAMP, default=get_pg_date)
+    delivered = db.Column(db.Boolean, default=False)
+    viewed = db.Column(db.Boolean, default=False)
+    # клиентский ключ сообщения для идемпотентной обработки повторных отправок
+    ext_key = db.Column(db.String(64))
+
+
+class ChatMessageTranslated(Base):
+    """
+    Переводы сообщений чатов
+    """
+
+    __table_args__ = {'schema': 'chat'}
+    __tablename__ = 'messages_translated'
+
+    message_id = db.Column(db.Integer, db.ForeignKey("chat.messages.id"), primary_key=True)
+    language = db.Column(db.String(8), db.ForeignKey("dictionary.languages.language_code"), primary_key=True)
+    translated = db.Column(db.String)
+
+
 class UserRequest(Base):
     """
     Таблица пользовательских заявок (в т.ч. удаление профиля)
@@ -5,6 +5,10 @@ from flask_restful import Api
 
 from resources.admin import resource_bp as admin_bp
 from resources.admin.resources import CacheAPI
+from resources.admin.cache_stats import TieredCacheStatsAPI
+from resources.admin.pipeline_stats import ChatPipelineStatsAPI
+from resources.admin.redis_stats import RedisPoolsAPI
+from resources.admin.sql_stats import SqlStatsAPI
 from resources.ads.resourses import Ads
 from resources.currencies import currencies_bp
 from resources.currencies.resources import CurrenciesAPI
@@ -125,4 +129,8 @@ api_push.add_resource(PushUserRegistrationToken, '/api/v1/push/reg_token/user')
 
 # API администратора
 api_admin = PublicAPI(admin_bp)
-api_admin.add_resource(CacheAPI, '/api/v1/admin/cache')
\ No newline at end of file
+api_admin.add_resource(CacheAPI, '/api/v1/admin/cache')
+api_admin.add_resource(SqlStatsAPI, '/api/v1/admin/sql_stats')
+api_admin.add_resource(RedisPoolsAPI, '/api/v1/admin/redis_pools')
+api_admin.add_resource(TieredCacheStatsAPI, '/api/v1/admin/tiered_caches')
+api_admin.add_resource(ChatPipelineStatsAPI, '/api/v1/admin/chat_pipeline')
@@ -0,0 +1,39 @@
+"""
+Модуль с ресурсом статистики двухуровневых кэшей
+"""
+from flask_apispec import doc, marshal_with, MethodResource
+from flask_restful import Resource
+from marshmallow import Schema, fields
+
+from resources.auth.schemas import SECURITY, Unauthorized, Forbidden
+from resources.utils import TieredCache
+from services.auth.utils import admin_required
+
+
+class TieredCacheItem(Schema):
+    name = fields.Str(description="префикс кэша")
+    local_hits = fields.Int(description="попадания в память процесса")
+    redis_hits = fields.Int(description="попадания в Redis")
+    misses = fields.Int(description="промахи")
+    local_size = fields.Int(description="число ключей в памяти процесса")
+    hit_rate = fields.Float(description="доля попаданий", allow_none=True)
+
+
+class TieredCacheList(Schema):
+    items = fields.List(fields.Nested(TieredCacheItem()), description="кэши воркера")
+
+
+@doc(security=SECURITY)
+@marshal_with(Unauthorized, code=401)
+@marshal_with(Forbidden, code=403)
+class TieredCacheStatsAPI(MethodResource, Resource):
+    """
+    API статистики двухуровневых кэшей воркера (переводы, языки, участники чатов)
+    """
+
+    @doc(description='статистика попаданий двухуровневых кэшей', tags=['Администратор'])
+    @marshal_with(TieredCacheList, code=200)
+    @admin_required()
+    def get(self):
+        items = [{"name": name, **cache.stats()} for name, cache in TieredCache.INSTANCES.items()]
+        return {"items": items}, 200
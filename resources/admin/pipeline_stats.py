@@ -0,0 +1,38 @@
+"""
+Модуль с ресурсом метрик фоновой обработки сообщений чата
+"""
+from flask_apispec import doc, marshal_with, MethodResource
+from flask_restful import Resource
+from marshmallow import Schema, fields
+
+from resources.auth.schemas import SECURITY, Unauthorized, Forbidden
+from resources.chat.pipeline import PIPELINE
+from services.auth.utils import admin_required
+
+
+class PipelineStageItem(Schema):
+    stage = fields.Str(description="стадия (queue - ожидание в очереди)")
+    count = fields.Int(description="число выполнений")
+    failed = fields.Int(description="число неудачных попыток")
+    total_ms = fields.Float(description="суммарное время, мс")
+    avg_ms = fields.Float(description="среднее время, мс")
+    max_ms = fields.Float(description="максимальное время, мс")
+
+
+class PipelineStageList(Schema):
+    items = fields.List(fields.Nested(PipelineStageItem()), description="стадии воркера")
+
+
+@doc(security=SECURITY)
+@marshal_with(Unauthorized, code=401)
+@marshal_with(Forbidden, code=403)
+class ChatPipelineStatsAPI(MethodResource, Resource):
+    """
+    API метрик фоновой обработки сообщений чата
+    """
+
+    @doc(description='задержки стадий фоновой обработки сообщений', tags=['Администратор'])
+    @marshal_with(PipelineStageList, code=200)
+    @admin_required()
+    def get(self):
+        return {"items": PIPELINE.metrics.to_list()}, 200
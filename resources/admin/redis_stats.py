@@ -0,0 +1,38 @@
+"""
+Модуль с ресурсом состояния пулов соединений Redis
+"""
+from flask_apispec import doc, marshal_with, MethodResource
+from flask_restful import Resource
+from marshmallow import Schema, fields
+
+from models.connection import redis_pool_stats
+from resources.auth.schemas import SECURITY, Unauthorized, Forbidden
+from services.auth.utils import admin_required
+
+
+class RedisPoolItem(Schema):
+    db = fields.Int(description="номер базы Redis")
+    decode_responses = fields.Bool(description="декодирование ответов")
+    max_connections = fields.Int(description="размер пула")
+    created = fields.Int(description="открыто соединений")
+    idle = fields.Int(description="свободно соединений")
+    in_use = fields.Int(description="занято соединений")
+
+
+class RedisPoolList(Schema):
+    items = fields.List(fields.Nested(RedisPoolItem()), description="пулы воркера")
+
+
+@doc(security=SECURITY)
+@marshal_with(Unauthorized, code=401)
+@marshal_with(Forbidden, code=403)
+class RedisPoolsAPI(MethodResource, Resource):
+    """
+    API состояния пулов соединений Redis воркера
+    """
+
+    @doc(description='состояние пулов соединений Redis', tags=['Администратор'])
+    @marshal_with(RedisPoolList, code=200)
+    @admin_required()
+    def get(self):
+        return {"items": redis_pool_stats()}, 200
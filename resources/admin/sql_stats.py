@@ -0,0 +1,52 @@
+"""
+Модуль с ресурсом статистики SQL запросов
+"""
+from flask_apispec import doc, marshal_with, MethodResource
+from flask_restful import Resource
+from marshmallow import Schema, fields
+
+from models.instrumentation import AGGREGATE
+from resources.auth.schemas import SECURITY, Unauthorized, Forbidden
+from services.auth.utils import admin_required
+
+
+class SqlStatsItem(Schema):
+    name = fields.Str(description="эндпоинт или событие сокета")
+    calls = fields.Int(description="число вызовов")
+    queries = fields.Int(description="число SQL запросов")
+    db_time_ms = fields.Float(description="суммарное время запросов, мс")
+    avg_queries = fields.Float(description="среднее число запросов на вызов")
+    avg_db_time_ms = fields.Float(description="среднее время запросов на вызов, мс")
+    max_queries = fields.Int(description="максимальное число запросов на вызов")
+    max_db_time_ms = fields.Float(description="максимальное время запросов на вызов, мс")
+    n_plus_one_calls = fields.Int(description="число вызовов с повторяющимися запросами (N+1)")
+
+
+class SqlStatsList(Schema):
+    items = fields.List(fields.Nested(SqlStatsItem()), description="статистика воркера")
+
+
+class SqlStatsCleared(Schema):
+    msg = fields.Str()
+
+
+@doc(security=SECURITY)
+@marshal_with(Unauthorized, code=401)
+@marshal_with(Forbidden, code=403)
+class SqlStatsAPI(MethodResource, Resource):
+    """
+    API статистики SQL запросов воркера
+    """
+
+    @doc(description='накопленная статистика SQL запросов по эндпоинтам и событиям сокета', tags=['Администратор'])
+    @marshal_with(SqlStatsList, code=200)
+    @admin_required()
+    def get(self):
+        return {"items": AGGREGATE.to_list()}, 200
+
+    @doc(description='сброс статистики SQL запросов', tags=['Администратор'])
+    @marshal_with(SqlStatsCleared, code=200)
+    @admin_required()
+    def delete(self):
+        AGGREGATE.clear()
+        return {"msg": "sql stats cleared"}, 200
@@ -1,10 +1,28 @@
 from flask_socketio import SocketIO
 
-# from models.connection import get_redis_connection_url
+from configs import configs
+from models.connection import get_redis_connection_url
 from .actions import Chat
-# from configs import configs
 
-socket_io = SocketIO(cors_allowed_origins="*")
+
+SOCKET_IO_CONFIG = configs.get('socket_io') or {}
+
+
+def get_message_queue():
+    """
+    Адрес очереди сообщений Redis для работы нескольких воркеров/узлов: события, отправленные в sid или комнату
+    другого процесса, доставляются через неё. Без очереди события доходят только до сокетов текущего процесса
+    """
+
+    if not SOCKET_IO_CONFIG.get('message_queue'):
+        return None
+
+    return get_redis_connection_url(SOCKET_IO_CONFIG.get('message_queue_db') or configs.get('redis').get('socket_db'))
+
+
+socket_io = SocketIO(cors_allowed_origins="*",
+                     message_queue=get_message_queue(),
+                     channel=SOCKET_IO_CONFIG.get('channel') or 'flask-socketio')
 
 
 # регистрация обработчиков
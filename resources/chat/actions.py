@@ -1,33 +1,58 @@
+from functools import wraps
 from traceback import format_exc
 from typing import Optional
 from collections import namedtuple
 
 from flask_jwt_extended import decode_token
-from flask_socketio import Namespace, disconnect
-from flask import request, session as flask_session
+from flask_socketio import Namespace, disconnect, join_room
+from flask import request, session as flask_session, current_app
 
 from logger import get_logger
-from models.connection import session
-from models.models import Users
-from resources.utils import RedisDict
+from models.instrumentation import track_queries
+from resources.chat.cache import get_chat_participants, get_user_partners, is_user_allowed
 from resources.chat.model import TextMessage, ActionMessage
-from resources.chat.utils import Actions
+from resources.chat.pipeline import PIPELINE
+from resources.chat.receipts import RECEIPTS
+from resources.chat.serialization import MSGPACK, MSGPACK_SOCKETS, emit_formatted, format_room, negotiate_serializer
+from resources.chat.typing_indicator import TYPING
+from resources.chat.utils import Actions, MessageType, user_room
+from services.chat.presence import PRESENCE
 
 UserSession = namedtuple("UserSession", ("sid", "user_id", "client_id"))
 
 
+def keep_presence(handler):
+    """
+    Продление присутствия пользователя после обработчика события сокета.
+    Выполняется внутри обработчика, пока контекст запроса сокета ещё доступен
+    """
+
+    @wraps(handler)
+    def wrapper(self, *args):
+        try:
+            return handler(self, *args)
+        finally:
+            self.touch_presence()
+
+    return wrapper
+
+
 class Connection(Namespace):
-    __slots__ = ("_LOGGER", "__REDIS")
+    __slots__ = ("_LOGGER", )
 
     def __init__(self, namespace=None):
         Namespace.__init__(self, namespace=namespace)
         self._LOGGER = get_logger("InitConnection", "SocketIO-InitConnection")
-        self.__REDIS = RedisDict()
 
     @property
     def logger(self):
         return self._LOGGER
 
+    def trigger_event(self, event, *args):
+        # учёт SQL запросов в разрезе событий сокета
+        with track_queries(f"socket {self.namespace} {event}"):
+            return Namespace.trigger_event(self, event, *args)
+
     def __verify_session(self) -> Optional[UserSession]:
         """
         Верификация пользовательской сессии
@@ -47,12 +72,7 @@ class Connection(Namespace):
                               error.__class__.__name__, error, format_exc())
             return None
 
-        with session() as ses:
-            user_ok = ses.query(
-                ses.query(Users).filter(Users.user_id == user_id, Users.banned.isnot(True)).exists()
-            ).scalar()
-
-        if not user_ok:
+        if not is_user_allowed(user_id):
             self.logger.error(f"Failed to establish connection user not found or banned")
             return None
 
@@ -64,8 +84,12 @@ class Connection(Namespace):
 
         flask_session["from"] = user_id
         flask_session["sid"] = sid
+        # формат данных событий, запрошенный клиентом
+        flask_session["serializer"] = negotiate_serializer()
+        # проверенная сессия хранится в сессии сокета и используется при отключении
+        flask_session["user_session"] = UserSession(sid, user_id, client_id)
 
-        return UserSession(sid, user_id, client_id)
+        return flask_session["user_session"]
 
     def on_connect(self):
         """
@@ -77,24 +101,22 @@ class Connection(Namespace):
             disconnect()
             return
 
-        # добавляем новую сессию пользователя в хранилище
-        sids: dict = self.__REDIS.get(user_session.user_id, default={})
-        sids[user_session.client_id] = user_session.sid
-        self.__REDIS[user_session.user_id] = sids
+        # комната всех устройств пользователя, через неё доставляются события, реестр сессий не нужен.
+        # При отключении сокет удаляется из комнат автоматически
+        join_room(format_room(user_room(user_session.user_id), flask_session["serializer"]))
+
+        if flask_session["serializer"] == MSGPACK:
+            MSGPACK_SOCKETS.add(user_session.user_id)
 
     def on_disconnect(self):
         """
         Отключение клиента
         """
-        user_session = self.__verify_session()
-
-        if not user_session:
-            return
+        # сессия проверена при подключении, повторная проверка токена и пользователя не нужна
+        user_session = flask_session.get("user_session")
 
-        # удаляем сессию пользователя из хранилища
-        sids: dict = self.__REDIS[user_session.user_id]
-        sids.pop(user_session.client_id, None)
-        self.__REDIS[user_session.user_id] = sids
+        if user_session and flask_session.get("serializer") == MSGPACK:
+            MSGPACK_SOCKETS.remove(user_session.user_id)
 
 
 class Chat(Connection):
@@ -102,10 +124,31 @@ class Chat(Connection):
     действия с чатом
     """
 
+    def touch_presence(self):
+        """
+        Любая активность сокета продлевает присутствие пользователя
+        """
+        if not (user_id := flask_session.get("from")):
+            return
+
+        try:
+            PRESENCE.touch(user_id, self.__notify_presence)
+        except Exception as e:
+            self.logger.error(f"Не удалось продлить присутствие: {str(e)}\n{format_exc()}")
+
+    @keep_presence
+    def on_connect(self):
+        Connection.on_connect(self)
+
+    @keep_presence
     def on_message(self, data):
         msg = TextMessage(data)
         try:
-            msg.save_to_db()
+            # отметка доставки записывается вместе с сообщением
+            msg.ingest()
+            if msg.in_progress:
+                # исходная отправка ещё не завершена, подтверждение придёт по ней или по следующему повтору
+                return
         except Exception as e:
             self.logger.error(f"Не удалось отправить сообщение: {str(e)}\n{format_exc()}")
             # обратное уведомление об ошибке
@@ -122,13 +165,96 @@ class Chat(Connection):
             "chat_id": msg.chat_id,
         })
 
-        ActionMessage(action_data).reverse_recipients().do_action().clear_from().send()
+        ActionMessage(action_data).reverse_recipients().clear_from().send()
+
+        if msg.duplicate or msg.rejected:
+            # повторная отправка: подтверждения исходного сообщения достаточно,
+            # сообщение не участника чата не доставляется
+            return
+
+        # исходный текст доставляется сразу, перевод и push уведомления выполняются в фоне
+        msg.send()
+        PIPELINE.submit(current_app._get_current_object(), self.__post_process, msg)
 
-        msg.translate().send().push()
+    def __post_process(self, msg: TextMessage):
+        """
+        Фоновая обработка доставленного сообщения: перевод, событие с переводом получателю, push уведомления
+        """
+        payload = msg.to_dict()
+
+        if PIPELINE.run_stage("translate", msg.translate, False, payload=payload) and msg.translated:
+            PIPELINE.run_stage("emit_translated", self.__emit_translated, msg, payload=payload)
+
+        PIPELINE.run_stage("push", msg.push, payload=payload)
 
+    def __emit_translated(self, msg: TextMessage):
+        emit_formatted(self.emit, MessageType.TRANSLATED, msg.translation_dict(), [msg.recipient.user_id])
+
+    @keep_presence
     def on_action(self, data):
+        if data.get("action") in (Actions.TYPING, Actions.STOP_TYPING) and data.get("chat_id"):
+            # эфемерные события: без БД и Redis, не чаще одного события за интервал
+            if data["action"] == Actions.TYPING:
+                TYPING.typing(data["chat_id"], flask_session["from"], self.__notify_typing)
+            else:
+                TYPING.stop(data["chat_id"], flask_session["from"], self.__notify_typing)
+            return
+
+        if data.get("action") in (Actions.VIEWED, Actions.DELIVERED) and data.get("chat_id") \
+                and data.get("message_id"):
+            # отметка "до сообщения N", пачка отметок за окно применяется одной записью
+            RECEIPTS.submit(data["action"], data["chat_id"], flask_session["from"], data["message_id"],
+                            self.__notify_receipt)
+            return
+
+        if data.get("action") in (Actions.ONLINE, Actions.OFFLINE):
+            # присутствие хранится в Redis, собеседники уведомляются только при смене состояния
+            try:
+                if data["action"] == Actions.ONLINE:
+                    PRESENCE.online(flask_session["from"], self.__notify_presence)
+                else:
+                    PRESENCE.offline(flask_session["from"], self.__notify_presence)
+            except Exception as e:
+                self.logger.error(f"Не удалось обновить присутствие: {str(e)}\n{format_exc()}")
+            return
+
         msg = ActionMessage(data)
         try:
             msg.do_action().send()
         except Exception as e:
             self.logger.error(f"Не удалось отправить активность: {str(e)}\n{format_exc()}")
+
+    def __notify_receipt(self, chat_id: int, user_id, data: dict):
+        """
+        Событие об отметке доставки/просмотра остальным участникам чата
+        """
+        data = dict(data, type=MessageType.ACTION, sender=user_id)
+
+        if recipients := [participant for participant in get_chat_participants(chat_id)
+                          if str(participant) != str(user_id)]:
+            emit_formatted(self.emit, MessageType.ACTION, data, recipients)
+
+    def __notify_presence(self, user_id, online: bool):
+        """
+        Событие о смене состояния пользователя его собеседникам
+        """
+        data = {"sender": user_id,
+                "type": MessageType.ACTION,
+                "action": (Actions.ONLINE if online else Actions.OFFLINE).value}
+
+        if partners := get_user_partners(user_id):
+            emit_formatted(self.emit, MessageType.ACTION, data, partners)
+
+    def __notify_typing(self, chat_id: int, user_id, action: Actions):
+        """
+        Событие о наборе текста остальным участникам чата
+        """
+        participants = get_chat_participants(chat_id)
+
+        if str(user_id) not in map(str, participants):
+            return
+
+        data = {"sender": user_id, "type": MessageType.ACTION, "action": action.value, "chat_id": chat_id}
+
+        if recipients := [participant for participant in participants if str(participant) != str(user_id)]:
+            emit_formatted(self.emit, MessageType.ACTION, data, recipients)
@@ -0,0 +1,212 @@
+"""
+Кэши данных, необходимых для обработки сообщений чата
+"""
+from typing import Iterable, List
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, aliased, object_session
+
+from configs import configs
+from models.connection import session
+from models.models import Users, UserXChat
+from resources.utils import TieredCache
+
+
+CHAT_CONFIG = configs.get('chat') or {}
+
+# язык пользователя: user_id -> language_id
+LANGUAGES = TieredCache("user_language",
+                        ttl=CHAT_CONFIG.get('language_cache_ttl') or 60,
+                        redis_ttl=CHAT_CONFIG.get('language_cache_redis_ttl') or 600)
+# участники чата: chat_id -> [user_id, ...]
+PARTICIPANTS = TieredCache("chat_participants", ttl=CHAT_CONFIG.get('participants_cache_ttl') or 300)
+# собеседники пользователя по всем его чатам: user_id -> [user_id, ...]
+# оба уровня живут не дольше partners_cache_ttl: локальные копии других воркеров сбросом не затрагиваются
+PARTNERS = TieredCache("user_partners",
+                       ttl=CHAT_CONFIG.get('partners_cache_ttl') or 60,
+                       redis_ttl=CHAT_CONFIG.get('partners_cache_ttl') or 60)
+# допуск пользователя к чату (существует и не заблокирован): user_id -> bool
+# кэшируется только допуск, оба уровня живут не дольше user_status_cache_ttl: блокировка массовым UPDATE
+# или SQL вне ORM вступает в силу по истечении ttl
+USER_STATUS = TieredCache("user_status",
+                          ttl=CHAT_CONFIG.get('user_status_cache_ttl') or 30,
+                          redis_ttl=CHAT_CONFIG.get('user_status_cache_ttl') or 30)
+
+
+# ключ информации сессии SQLAlchemy со списком ключей кэшей, сбрасываемых после фиксации транзакции
+PENDING_INVALIDATION = "chat_cache_invalidation"
+
+
+def invalidate_after_commit(target, cache: TieredCache, key):
+    """
+    Сброс ключа кэша после фиксации транзакции, в которой изменён объект. Сброс во время flush позволяет
+    параллельному промаху прочитать старое значение до фиксации и снова записать его в кэш
+
+    :param target: изменённый объект модели
+    :param cache: кэш
+    :param key: ключ кэша
+    """
+
+    if (ses := object_session(target)) is None:
+        cache.delete(key)
+        return
+
+    ses.info.setdefault(PENDING_INVALIDATION, []).append((cache, key))
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_pending_invalidation(ses: Session):
+    for cache, key in ses.info.pop(PENDING_INVALIDATION, []):
+        cache.delete(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_pending_invalidation(ses: Session):
+    # изменения отменены, кэш остаётся актуальным
+    ses.info.pop(PENDING_INVALIDATION, None)
+
+
+def get_user_language(user_id):
+    """
+    Язык пользователя, при промахе кэша с основной базы читается только колонка языка
+
+    :param user_id: идентификатор пользователя
+    """
+
+    language = LANGUAGES.get(user_id)
+
+    if language is LANGUAGES.MISSING:
+        # чтение по первичному ключу с основной базы: отстающая реплика сразу после сброса кэша
+        # вернула бы прежний язык, и он снова попал бы в кэш
+        with session() as ses:
+            language = ses.query(Users.language_id).filter(Users.user_id == user_id).scalar()
+        # несуществующий пользователь не кэшируется
+        if language is not None:
+            LANGUAGES.set(user_id, language)
+
+    return language
+
+
+@event.listens_for(Users, 'after_update')
+def invalidate_user_language(_mapper, _connection, target: Users):
+    """
+    Сброс кэша языка при изменении профиля пользователя
+    """
+
+    if inspect(target).attrs.language_id.history.has_changes():
+        invalidate_after_commit(target, LANGUAGES, target.user_id)
+
+
+def is_user_allowed(user_id) -> bool:
+    """
+    Пользователь существует и не заблокирован, проверка при подключении сокета
+
+    :param user_id: идентификатор пользователя
+    """
+
+    if USER_STATUS.get(user_id) is True:
+        return True
+
+    def check(readonly: bool) -> bool:
+        with session(readonly=readonly) as ses:
+            return ses.query(
+                ses.query(Users).filter(Users.user_id == user_id, Users.banned.isnot(True)).exists()
+            ).scalar()
+
+    # отказ перепроверяется на основной базе: новый пользователь может ещё не появиться на реплике
+    if allowed := check(readonly=True) or check(readonly=False):
+        USER_STATUS.set(user_id, True)
+
+    return allowed
+
+
+@event.listens_for(Users, 'after_update')
+def invalidate_user_status(_mapper, _connection, target: Users):
+    """
+    Сброс кэша допуска при блокировке и разблокировке пользователя
+    """
+
+    if inspect(target).attrs.banned.history.has_changes():
+        invalidate_after_commit(target, USER_STATUS, target.user_id)
+
+
+def get_chat_participants(chat_id) -> List[int]:
+    """
+    Участники чата
+
+    :param chat_id: идентификатор чата
+    """
+
+    return warm_chat_participants((chat_id, )).get(int(chat_id), [])
+
+
+def warm_chat_participants(chat_ids: Iterable) -> dict:
+    """
+    Участники нескольких чатов: промахи кэша загружаются из БД одним запросом и сохраняются в кэш
+
+    :param chat_ids: идентификаторы чатов
+    :return: словарь chat_id (int) -> список участников
+    """
+
+    # идентификаторы из данных сокета могут быть строками
+    chat_ids = list(dict.fromkeys(int(chat_id) for chat_id in chat_ids if chat_id is not None))
+    found = PARTICIPANTS.get_many(chat_ids)
+
+    if missed := [chat_id for chat_id in chat_ids if chat_id not in found]:
+        loaded = {chat_id: [] for chat_id in missed}
+        with session(readonly=True) as ses:
+            rows = ses.query(UserXChat.chat_id, UserXChat.user_id).filter(UserXChat.chat_id.in_(missed)).all()
+
+        for row in rows:
+            loaded[row.chat_id].append(row.user_id)
+
+        # несуществующие чаты не кэшируются
+        PARTICIPANTS.set_many({chat_id: users for chat_id, users in loaded.items() if users})
+        found.update(loaded)
+
+    return found
+
+
+def set_chat_participants(chat_id, user_ids: List[int]):
+    """
+    Сохранение участников чата в кэш (при создании чата)
+
+    :param chat_id: идентификатор чата
+    :param user_ids: идентификаторы участников
+    """
+
+    PARTICIPANTS.set(int(chat_id), list(user_ids))
+
+
+def get_user_partners(user_id) -> List[int]:
+    """
+    Собеседники пользователя (участники его чатов), получатели событий присутствия
+
+    :param user_id: идентификатор пользователя
+    """
+
+    partners = PARTNERS.get(int(user_id))
+
+    if partners is PARTNERS.MISSING:
+        other = aliased(UserXChat)
+        # чтение с основной базы: сброс выполняется сразу после создания чата,
+        # отстающая реплика вернула бы прежний список
+        with session() as ses:
+            partners = [partner for partner, in ses.query(other.user_id).
+                        join(UserXChat, UserXChat.chat_id == other.chat_id).
+                        filter(UserXChat.user_id == user_id, other.user_id != user_id).
+                        distinct()]
+        PARTNERS.set(int(user_id), partners)
+
+    return partners
+
+
+def invalidate_user_partners(*user_ids):
+    """
+    Сброс кэша собеседников (при создании чата)
+
+    :param user_ids: идентификаторы пользователей
+    """
+
+    for user_id in user_ids:
+        PARTNERS.delete(int(user_id))
@@ -0,0 +1,146 @@
+"""
+Счётчики непрочитанных сообщений, поддерживаемые инкрементально в Redis
+"""
+from typing import Dict, Tuple
+
+from sqlalchemy import func
+
+from configs import configs
+from models.connection import session, get_redis_client
+from models.models import ChatMessage
+from utils import SECONDS_PER_DAY
+
+
+class UnreadCounters:
+    """
+    Непрочитанные сообщения пользователя хранятся в хэше Redis: chat_id -> число, поле total - общее число.
+    Хэш строится из PostgreSQL при первом чтении и после истечения срока жизни, далее изменяется атомарно
+    при записи сообщения и при его просмотре. Пока хэш не построен, изменения пропускаются.
+    Каждое изменение увеличивает версию пользователя: снимок PostgreSQL записывается, только если версия
+    не изменилась с начала построения, иначе он мог пропустить изменение и не кэшируется
+    """
+
+    KEY = "unread:{}"
+    VERSION_KEY = "unread:{}:version"
+    TOTAL = "total"
+
+    # увеличение счётчика чата и общего счётчика
+    __INCREMENT_SCRIPT = """
+        redis.call('INCR', KEYS[2])
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+        return redis.call('HINCRBY', KEYS[1], ARGV[3], ARGV[2])
+    """
+
+    # уменьшение счётчика чата не ниже нуля
+    __DECREMENT_SCRIPT = """
+        redis.call('INCR', KEYS[2])
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+        local delta = tonumber(ARGV[2])
+        if delta > current then
+            delta = current
+        end
+        if delta == current then
+            redis.call('HDEL', KEYS[1], ARGV[1])
+        else
+            redis.call('HINCRBY', KEYS[1], ARGV[1], -delta)
+        end
+        return redis.call('HINCRBY', KEYS[1], ARGV[3], -delta)
+    """
+
+    # запись снимка, если версия не изменилась и хэш не построен другим процессом
+    __STORE_SCRIPT = """
+        local version = redis.call('GET', KEYS[2]) or ''
+        if version ~= ARGV[1] or redis.call('EXISTS', KEYS[1]) == 1 then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, db: int = configs.get('redis').get('socket_db')):
+        self.__redis = get_redis_client(db)
+        self.__increment = self.__redis.register_script(self.__INCREMENT_SCRIPT)
+        self.__decrement = self.__redis.register_script(self.__DECREMENT_SCRIPT)
+        self.__store = self.__redis.register_script(self.__STORE_SCRIPT)
+
+    @property
+    def ttl(self) -> int:
+        return (configs.get('chat') or {}).get('unread_counters_ttl') or SECONDS_PER_DAY
+
+    def __keys(self, user_id) -> list:
+        return [self.KEY.format(user_id), self.VERSION_KEY.format(user_id)]
+
+    def increment(self, user_id, chat_id, count: int = 1):
+        """
+        Учёт новых непрочитанных сообщений
+
+        :param user_id: получатель
+        :param chat_id: идентификатор чата
+        :param count: число сообщений
+        """
+
+        self.__increment(keys=self.__keys(user_id), args=[chat_id, count, self.TOTAL, self.ttl])
+
+    def decrement(self, user_id, chat_id, count: int = 1):
+        """
+        Учёт просмотренных сообщений
+
+        :param user_id: получатель
+        :param chat_id: идентификатор чата
+        :param count: число сообщений
+        """
+
+        self.__decrement(keys=self.__keys(user_id), args=[chat_id, count, self.TOTAL, self.ttl])
+
+    def get(self, user_id) -> Tuple[Dict[int, int], int]:
+        """
+        Счётчики пользователя
+
+        :param user_id: идентификатор пользователя
+        :return: непрочитанные по чатам и общее число
+        """
+
+        data = self.__redis.hgetall(self.KEY.format(user_id))
+
+        if not data:
+            return self.rebuild(user_id)
+
+        total = int(data.pop(self.TOTAL, 0))
+
+        return {int(chat_id): int(count) for chat_id, count in data.items()}, total
+
+    def rebuild(self, user_id) -> Tuple[Dict[int, int], int]:
+        """
+        Построение счётчиков пользователя по данным PostgreSQL. Если во время построения счётчики изменились,
+        снимок возвращается, но не записывается: хэш построит следующее чтение
+
+        :param user_id: идентификатор пользователя
+        """
+
+        version = self.__redis.get(self.VERSION_KEY.format(user_id)) or ''
+
+        with session() as ses:
+            rows = ses.query(ChatMessage.chat_id, func.count(ChatMessage.id)). \
+                filter(ChatMessage.receiver == user_id, ChatMessage.viewed.isnot(True)). \
+                group_by(ChatMessage.chat_id). \
+                all()
+
+        counters = {chat_id: count for chat_id, count in rows}
+        total = sum(counters.values())
+
+        fields = [item for pair in {**counters, self.TOTAL: total}.items() for item in pair]
+        self.__store(keys=self.__keys(user_id), args=[version, self.ttl, *fields])
+
+        return counters, total
+
+
+UNREAD = UnreadCounters()
@@ -0,0 +1,86 @@
+"""
+Идемпотентный приём сообщений по клиентскому ключу (отправитель, extKey)
+"""
+from json import loads, dumps
+from time import sleep
+from typing import Union
+
+from configs import configs
+from models.connection import get_redis_client
+
+
+class MessageDedup:
+    """
+    Окно дедупликации в Redis. Первая отправка захватывает ключ на время приёма, после записи сообщения в ключ
+    сохраняется подтверждение (message_id, время) на всё окно, повторные отправки в пределах окна получают
+    это подтверждение.
+    За пределами окна дубликаты отсекает уникальный ключ (sender, ext_key) таблицы сообщений
+    """
+
+    KEY = "msg_dedup:{}:{}"
+    PENDING = "pending"
+    # исходное сообщение ещё обрабатывается, повторная отправка отбрасывается без подтверждения
+    IN_PROGRESS = object()
+    # ожидание завершения параллельной обработки того же сообщения
+    WAIT_ATTEMPTS = 10
+    WAIT_INTERVAL = 0.05
+
+    def __init__(self, db: int = configs.get('redis').get('socket_db')):
+        self.__redis = get_redis_client(db)
+
+    @property
+    def window(self) -> int:
+        return (configs.get('chat') or {}).get('dedup_window') or 600
+
+    @property
+    def pending_ttl(self) -> int:
+        # чуть больше времени приёма сообщения: ключ воркера, остановленного до complete/release,
+        # освобождается быстро, и повторная отправка будет принята
+        return (configs.get('chat') or {}).get('dedup_pending_ttl') or 10
+
+    def claim(self, sender, ext_key) -> Union[None, dict, object]:
+        """
+        Захват ключа сообщения
+
+        :param sender: идентификатор отправителя
+        :param ext_key: клиентский ключ сообщения
+        :return: None для нового сообщения, для повторного - подтверждение исходного
+                 (IN_PROGRESS, если исходное ещё обрабатывается)
+        """
+
+        key = self.KEY.format(sender, ext_key)
+
+        if self.__redis.set(key, self.PENDING, nx=True, ex=self.pending_ttl):
+            return None
+
+        for _ in range(self.WAIT_ATTEMPTS):
+            value = self.__redis.get(key)
+            if value is None:
+                # исходная обработка завершилась ошибкой и освободила ключ
+                return self.claim(sender, ext_key)
+            if value != self.PENDING:
+                return loads(value)
+            sleep(self.WAIT_INTERVAL)
+
+        return self.IN_PROGRESS
+
+    def complete(self, sender, ext_key, ack: dict):
+        """
+        Сохранение подтверждения обработанного сообщения
+
+        :param sender: идентификатор отправителя
+        :param ext_key: клиентский ключ сообщения
+        :param ack: данные подтверждения
+        """
+
+        self.__redis.set(self.KEY.format(sender, ext_key), dumps(ack), ex=self.window)
+
+    def release(self, sender, ext_key):
+        """
+        Освобождение ключа после ошибки обработки, чтобы повторная отправка была принята
+
+        :param sender: идентификатор отправителя
+        :param ext_key: клиентский ключ сообщения
+        """
+
+        self.__redis.delete(self.KEY.format(sender, ext_key))
@@ -3,25 +3,43 @@
 """
 from abc import ABC, abstractmethod
 from traceback import format_exc
-from typing import Tuple
+from typing import List, Tuple
 
 from firebase_admin import messaging
 from firebase_admin.messaging import Notification
 from flask import session as flask_session
-from flask_socketio import emit
-from sqlalchemy import func
+from flask_socketio import emit, join_room
+from sqlalchemy import func, and_, update
+from sqlalchemy.exc import IntegrityError
 
 from configs import configs
 from logger import get_logger
 from models.connection import session
-from models.models import Users, ChatMessage, ChatMessageTranslated, UserXChat, Chat as ChatTable, get_pg_date
-from resources.chat.utils import Actions, MessageType, get_chats_query, translate_text
+from models.models import ChatMessage, ChatMessageTranslated, UserXChat, Chat as ChatTable, get_pg_date
+from resources.chat.counters import UNREAD
+from resources.chat.dedup import MessageDedup
+from resources.chat.serialization import JSON, emit_formatted
+from resources.chat.cache import get_user_language, get_chat_participants, set_chat_participants, \
+    warm_chat_participants, invalidate_user_partners
+from resources.chat.utils import Actions, MessageType, get_chats_query, translate_text, peek_translation, \
+    chat_room, to_int
 from resources.utils import RedisDict
 from services.utils import get_cached_service_element
 
 
 LOGGER = get_logger("ChatsLog", "ChatsLog")
 
+REDIS = RedisDict()
+DEDUP = MessageDedup()
+
+# максимальное число токенов в одном multicast запросе FCM
+FCM_BATCH_SIZE = 500
+
+CHAT_CONFIG = configs.get('chat') or {}
+# размер страницы истории чата по умолчанию и максимальный
+HISTORY_PAGE_SIZE = CHAT_CONFIG.get('history_page_size') or 50
+HISTORY_PAGE_MAX = CHAT_CONFIG.get('history_page_max') or 200
+
 
 class DictInterface(ABC):
     """
@@ -34,29 +52,42 @@ class DictInterface(ABC):
 
 
 class Client(DictInterface):
-    """Модель клиента"""
+    """
+    Модель клиента. Push токены и язык загружаются при первом обращении
+    и запоминаются на время жизни объекта (обработки сообщения)
+    """
 
     def __init__(self, user_id):
-        redis = RedisDict()
         self.user_id = user_id
-        self._sid_list = redis.get(user_id, {}).values()
         self._language = None
-        self.fcm_tokens = redis.get(f'{self.user_id}_fcm_token_set', default=[])
+        self._fcm_tokens = None
 
     @property
     def language(self):
         if self._language:
             return self._language
 
-        with session() as ses:
-            user: Users = ses.query(Users).filter_by(user_id=self.user_id).one()
-            self._language = user.language_id
+        self._language = get_user_language(self.user_id)
 
         return self._language
 
     @property
-    def sids(self):
-        return self._sid_list
+    def fcm_tokens(self):
+        if self._fcm_tokens is None:
+            self._fcm_tokens = REDIS.get(f'{self.user_id}_fcm_token_set', default=[])
+
+        return self._fcm_tokens
+
+    def remove_fcm_tokens(self, tokens: list):
+        """
+        Удаление недействительных push токенов из хранилища
+
+        :param tokens: токены
+        """
+        tokens = set(tokens)
+        self._fcm_tokens = REDIS.modify(f'{self.user_id}_fcm_token_set',
+                                        lambda current: [token for token in current if token not in tokens],
+                                        default=[])
 
     def to_dict(self):
         return {"user_id": self.user_id, "language": self.language}
@@ -67,14 +98,15 @@ class Client(DictInterface):
 
         :return: список чатов и число непрочитанных сообщений пользователя
         """
-        with session() as ses:
+        with session(readonly=True) as ses:
             chats_list = get_chats_query(ses, self.user_id)
 
         res = [chat._asdict() for chat in chats_list]
 
-        counter = 0
-        if res:
-            counter = sum((r["unseen_counter"] for r in res))
+        # непрочитанные берутся из инкрементальных счётчиков вместо агрегата по сообщениям
+        unread, counter = UNREAD.get(self.user_id)
+        for r in res:
+            r["unseen_counter"] = unread.get(int(r["chat_id"]), 0)
 
         return res, counter
 
@@ -86,18 +118,48 @@ class Chat(DictInterface):
         self.chat_id = chat_id
         self.messages = None
         self.subject = None
+        self.next_cursor = None
 
-    def load_messages(self):
-        with session() as ses:
-            """
-            
-            Здесь должно быть получение по chat_id из БД
-            
-            """
-
-            res = []
+    def load_messages(self, language: str = None, cursor: int = None, limit: int = None):
+        """
+        Загрузка страницы истории чата от новых сообщений к старым (keyset пагинация по идентификатору сообщения).
+        Сообщения страницы возвращаются в хронологическом порядке вместе с переводами на язык читателя
 
-            self.messages = [r._asdict() for r in res]
+        :param language: язык читателя
+        :param cursor: идентификатор сообщения, до которого загружается страница (next_cursor предыдущей страницы)
+        :param limit: размер страницы
+        """
+        limit = max(1, min(to_int(limit) or HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX))
+        cursor = to_int(cursor)
+
+        with session(readonly=True) as ses:
+            query = ses.query(ChatMessage.id.label("message_id"),
+                              ChatMessage.sender,
+                              ChatMessage.text,
+                              ChatMessage.timestamp,
+                              ChatMessage.delivered,
+                              ChatMessage.viewed,
+                              ChatMessageTranslated.translated). \
+                outerjoin(ChatMessageTranslated, and_(ChatMessageTranslated.message_id == ChatMessage.id,
+                                                      ChatMessageTranslated.language == language)). \
+                filter(ChatMessage.chat_id == self.chat_id)
+
+            if cursor:
+                query = query.filter(ChatMessage.id < cursor)
+
+            res = query.order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+
+        # лишняя запись означает наличие более старых сообщений
+        self.next_cursor = res[limit - 1].message_id if len(res) > limit else None
+
+        self.messages = []
+        for r in reversed(res[:limit]):
+            message = r._asdict()
+            message["timestamp"] = get_pg_date(r.timestamp)
+            message["time"] = message["timestamp"].split(" ")[1].rsplit(":", 1)[0]
+            message["chat_id"] = self.chat_id
+            message["type"] = MessageType.MESSAGE
+            self.messages.append(message)
 
         return self
 
@@ -134,12 +196,9 @@ class Message(DictInterface):
             return self._to
 
         if self.chat_id:
-            # заполнение получателя по таблице связи чата и пользователей
-            with session() as ses:
-                user_id = ses.query(UserXChat.user_id). \
-                    filter(UserXChat.chat_id == self.chat_id,
-                           UserXChat.user_id != flask_session["from"]). \
-                    scalar()
+            # заполнение получателя по участникам чата
+            user_id = next((user_id for user_id in get_chat_participants(self.chat_id)
+                            if str(user_id) != str(flask_session["from"])), None)
 
             self._to = Client(user_id)
 
@@ -172,17 +231,31 @@ class Message(DictInterface):
         if not self.recipient:
             return self
 
-        for sid in self.recipient.sids:
-            # отправка на все устройства получателя
-            emit(self.type, self.to_dict(), to=sid)
+        # данные события собираются один раз и кодируются один раз для каждого формата,
+        # сокеты всех адресатов выбираются по комнатам
+        # (сокет может состоять в нескольких комнатах из списка, событие он получит один раз)
+        skip_sid = flask_session.get("sid") \
+            if self.sender and str(self.sender.user_id) == str(flask_session.get("from")) else None
+        emit_formatted(emit, self.type, self.to_dict(), self.recipients(), self.rooms(), skip_sid=skip_sid)
+
+        return self
+
+    def recipients(self) -> list:
+        """
+        Адресаты: все устройства получателя и другие устройства отправителя
+        """
+        recipients = [self.recipient.user_id]
 
         if self.sender:
-            for sid in self.sender.sids:
-                # отправка на другие устройства отправителя, если они у него есть
-                if sid != flask_session["sid"]:
-                    emit(self.type, self.to_dict(), to=sid)
+            recipients.append(self.sender.user_id)
 
-        return self
+        return recipients
+
+    def rooms(self) -> List[str]:
+        """
+        Дополнительные комнаты адресатов
+        """
+        return []
 
     def reverse_recipients(self):
         """
@@ -206,35 +279,132 @@ class TextMessage(Message):
         self.text = data.get("text")
         self.ext_key = data.get("extKey")
         self.translated = None
-
-    def translate(self):
+        # перевод записан в БД (вместе с сообщением или отдельно)
+        self.translation_stored = False
+        # повторная отправка уже принятого сообщения
+        self.duplicate = False
+        # исходная отправка с тем же extKey ещё обрабатывается, повтор отброшен
+        self.in_progress = False
+        # отправитель не участник чата, сообщение не принято
+        self.rejected = False
+        # токены, push уведомление на которые ещё не отправлено (None: все токены получателя)
+        self.push_tokens = None
+
+    def translate(self, fallback: bool = True):
         """
         Перевести сообщение. Выполнить это действие можно только после сохранения в БД
+
+        :param fallback: при ошибке перевода использовать исходный текст, иначе ошибка пробрасывается
         """
+        if self.translation_stored:
+            # перевод уже записан вместе с сообщением или предыдущей попыткой
+            return self
+
         if self.sender.language != self.recipient.language and self.message_id:
             try:
-                self.translated, _ = translate_text(self.text, self.recipient.language, self.sender.language)
+                translated, _ = translate_text(self.text, self.recipient.language, self.sender.language)
             except Exception as err:
+                if not fallback:
+                    raise
                 self.translated = self.text
                 LOGGER.error(f"Не удалось перевести сообщение {self.message_id}: {str(err)}\n{format_exc()}")
             else:
                 with session() as ses:
                     ses.add(ChatMessageTranslated(message_id=self.message_id,
                                                   language=self.recipient.language,
-                                                  translated=self.translated))
+                                                  translated=translated))
                     ses.commit()
+                # перевод сохраняется в сообщении только после фиксации записи, повтор стадии запишет его снова
+                self.translated = translated
+                self.translation_stored = True
 
         return self
 
-    def save_to_db(self):
+    def ingest(self):
+        """
+        Приём сообщения одной единицей работы: получатель и языки берутся из кэшей, сообщение записывается
+        одной транзакцией вместе с отметкой доставки и переводом, если он уже есть в кэше переводов.
+
+        Повторная отправка с тем же extKey не записывается: сообщение помечается как duplicate
+        и получает идентификатор и время исходного. Если исходное ещё обрабатывается, повтор помечается
+        in_progress и не подтверждается: клиент повторит отправку.
+
+        Сообщение отправителя, не состоящего в чате, не принимается (rejected)
+        """
+        participants = get_chat_participants(self.chat_id) if to_int(self.chat_id) else []
+        if str(self.sender.user_id) not in map(str, participants):
+            self.rejected = True
+            raise PermissionError(f"Пользователь {self.sender.user_id} не участник чата {self.chat_id}")
+
+        if self.ext_key:
+            original = DEDUP.claim(self.sender.user_id, self.ext_key)
+            if original is DEDUP.IN_PROGRESS:
+                self.in_progress = True
+                return self
+            if original is not None:
+                self.__set_original(original)
+                return self
+
+        if self.text and self.sender.language != self.recipient.language:
+            self.translated = peek_translation(self.text, self.recipient.language, self.sender.language)
+
+        try:
+            try:
+                self.save_to_db(delivered=True)
+            except IntegrityError:
+                if not self.ext_key:
+                    raise
+                # окно дедупликации истекло, дубликат отсечён уникальным ключом таблицы
+                with session() as ses:
+                    original = ses.query(ChatMessage.id, ChatMessage.timestamp). \
+                        filter_by(sender=self.sender.user_id, ext_key=self.ext_key). \
+                        first()
+                if original is None:
+                    # нарушено другое ограничение (чат, получатель), сообщение не записано
+                    raise
+                timestamp = get_pg_date(original.timestamp)
+                self.__set_original({"message_id": original.id,
+                                     "timestamp": timestamp,
+                                     "time": timestamp.split(" ")[1].rsplit(":", 1)[0]})
+        except Exception:
+            # ключ освобождается при любой ошибке, в том числе при поиске исходного сообщения
+            if self.ext_key:
+                DEDUP.release(self.sender.user_id, self.ext_key)
+            raise
+
+        if self.ext_key:
+            DEDUP.complete(self.sender.user_id, self.ext_key, {"message_id": self.message_id,
+                                                                "timestamp": self.timestamp,
+                                                                "time": self.time})
+
+        if not self.duplicate:
+            UNREAD.increment(self.recipient.user_id, self.chat_id)
+
+        return self
+
+    def __set_original(self, ack: dict):
+        self.duplicate = True
+        self.translated = None
+        self.translation_stored = False
+        self.message_id = ack.get("message_id")
+        self.timestamp = ack.get("timestamp")
+        self.time = ack.get("time")
+
+    def save_to_db(self, delivered: bool = False):
         """
         запись сообщени в БД
+
+        :param delivered: сразу отметить сообщение доставленным
         """
+        state = {Actions.DELIVERED.value: True} if delivered else {}
+
         with session() as ses:
             ses.add(msg := ChatMessage(chat_id=self.chat_id,
                                        sender=self.sender.user_id,
                                        receiver=self.recipient.user_id,
-                                       text=self.text))
+                                       text=self.text,
+                                       ext_key=self.ext_key,
+                                       **state))
             ses.flush()
 
             self.timestamp = msg.timestamp
@@ -250,6 +420,8 @@ class TextMessage(Message):
 
             ses.commit()
 
+        self.translation_stored = bool(self.translated)
+
         return self
 
     def to_dict(self) -> dict:
@@ -261,28 +433,86 @@ class TextMessage(Message):
 
         return res
 
+    def recipients(self) -> list:
+        """
+        Адресаты: все участники чата, в том числе другие устройства отправителя
+        """
+        if not self.chat_id:
+            return Message.recipients(self)
+
+        return get_chat_participants(self.chat_id)
+
+    def rooms(self) -> List[str]:
+        """
+        Комната чата
+        """
+        return [chat_room(self.chat_id)] if self.chat_id else []
+
+    def translation_dict(self) -> dict:
+        """
+        Данные события с переводом ранее доставленного сообщения
+        """
+        return {
+            "type": MessageType.TRANSLATED,
+            "chat_id": self.chat_id,
+            "message_id": self.message_id,
+            "translated": self.translated
+        }
+
     def push(self):
         """
-        Отправка Push уведомления об отправленном пользователю сообщении
+        Отправка Push уведомления об отправленном пользователю сообщении.
+        Если запрос пачки токенов не выполнен, пачка остаётся в push_tokens и ошибка пробрасывается:
+        повторный вызов отправляет только неотправленные пачки
         """
         title_translate = get_cached_service_element(element_code='chat_push',
                                                      translate_code=self.recipient.language)
         if not title_translate:
             title_translate = get_cached_service_element(element_code='chat_push',
                                                          translate_code='en')
-        message = messaging.Message(data={'time': get_pg_date(),
-                                          'chat_id': self.chat_id,
-                                          'url': f"{configs['domain']['url']}/chats/{self.chat_id}"},
-                                    notification=Notification(title=title_translate.get('element_name'),
-                                                              body=self.translated or self.text,
-                                                              image='/img/Logo.svg'))
-        for token in self.recipient.fcm_tokens:
+        data = {'time': get_pg_date(),
+                'chat_id': str(self.chat_id),
+                'url': f"{configs['domain']['url']}/chats/{self.chat_id}"}
+        notification = Notification(title=title_translate.get('element_name'),
+                                    body=self.translated or self.text,
+                                    image='/img/Logo.svg')
+
+        if self.push_tokens is None:
+            self.push_tokens = list(self.recipient.fcm_tokens)
+
+        tokens, self.push_tokens = self.push_tokens, []
+        unregistered = []
+        error = None
+
+        for i in range(0, len(tokens), FCM_BATCH_SIZE):
+            batch = tokens[i:i + FCM_BATCH_SIZE]
             try:
-                message.token = token
-                messaging.send(message)
+                response = messaging.send_each_for_multicast(
+                    messaging.MulticastMessage(tokens=batch, data=data, notification=notification)
+                )
             except Exception as err:
-                LOGGER.error(f"Не удалось доставить push уведомление пользователю (token: {token} "
-                             f"{self.recipient.user_id}: {str(err)}\n{format_exc()}")
+                LOGGER.error(f"Не удалось доставить push уведомления пользователю {self.recipient.user_id} "
+                             f"({len(batch)} токенов): {str(err)}\n{format_exc()}")
+                self.push_tokens.extend(batch)
+                error = err
+                continue
+
+            for token, res in zip(batch, response.responses):
+                if res.success:
+                    continue
+                if isinstance(res.exception, messaging.UnregisteredError):
+                    unregistered.append(token)
+                else:
+                    LOGGER.error(f"Не удалось доставить push уведомление пользователю (token: {token} "
+                                 f"{self.recipient.user_id}: {str(res.exception)}")
+
+        if unregistered:
+            # токены удалённых приложений больше не используются
+            self.recipient.remove_fcm_tokens(unregistered)
+
+        if error:
+            # повтор стадии отправит только пачки с ошибкой
+            raise error
 
         return self
 
@@ -297,34 +527,51 @@ class ActionMessage(Message):
 
         self.__chat_id = data.get("chat_id")
         self.__ext_key = data.get("extKey")
+        self.__cursor = data.get("cursor")
+        self.__limit = data.get("limit")
         self.__chats = None
         self.__chat = None
         self.__unseen_counter = None
         self.__chat_messages = None
+        self.__next_cursor = None
 
     def do_action(self):
         # подготовка данных для активностей, исполнение активностей
-        if self.action in (Actions.VIEWED, Actions.DELIVERED):
+        if self.action == Actions.DELIVERED:
             with session() as ses:
                 ses.query(ChatMessage).filter_by(id=self.message_id).update({self.action: True})
                 ses.commit()
 
+        if self.action == Actions.VIEWED:
+            with session() as ses:
+                viewed = ses.execute(update(ChatMessage).
+                                     where(ChatMessage.id == self.message_id, ChatMessage.viewed.isnot(True)).
+                                     values(viewed=True).
+                                     returning(ChatMessage.chat_id, ChatMessage.receiver)).all()
+                ses.commit()
+
+            for chat_id, receiver in viewed:
+                UNREAD.decrement(receiver, chat_id)
+
         if self.action == Actions.LOAD_CHATS:
             self.__chats, self.__unseen_counter = self.sender.chats()
+            # прогрев кэша участников для последующих сообщений в эти чаты
+            warm_chat_participants(chat.get("chat_id") for chat in self.__chats)
+            if flask_session.get("serializer", JSON) == JSON:
+                # msgpack сокеты получают события чата через комнату пользователя
+                for chat in self.__chats:
+                    join_room(chat_room(chat.get("chat_id")))
             self.reverse_recipients()
 
         if self.action == Actions.LOAD_CHAT_MSG and self.__chat_id:
-            self.__chat_messages = Chat(self.__chat_id).load_messages().messages
+            if str(self.sender.user_id) in map(str, get_chat_participants(self.__chat_id)):
+                chat = Chat(self.__chat_id).load_messages(self.sender.language, self.__cursor, self.__limit)
+                self.__chat_messages, self.__next_cursor = chat.messages, chat.next_cursor
+            else:
+                # история доступна только участникам чата
+                self.__chat_messages = []
             self.reverse_recipients()
 
-        if self.action == Actions.ONLINE or self.action == Actions.OFFLINE:
-            with session() as ses:
-                ses.query(Users).\
-                    filter_by(user_id=self.sender.user_id).\
-                    update({"online": self.action == Actions.ONLINE})
-                ses.commit()
-            self.broadcast = True
-
         if self.action == Actions.INIT_CHAT:
             with session() as ses:
                 ses.add(chat := ChatTable(entity_id=self.subject))
@@ -332,6 +579,10 @@ class ActionMessage(Message):
                 ses.add(UserXChat(user_id=self.sender.user_id, chat_id=chat.id))
                 ses.add(UserXChat(user_id=self.recipient.user_id, chat_id=chat.id))
                 ses.commit()
+                set_chat_participants(chat.id, (self.sender.user_id, self.recipient.user_id))
+                invalidate_user_partners(self.sender.user_id, self.recipient.user_id)
+                if flask_session.get("serializer", JSON) == JSON:
+                    join_room(chat_room(chat.id))
                 self.__chat = get_chats_query(ses, self.sender.user_id, chat.id).one()._asdict()
             self.reverse_recipients()
 
@@ -350,6 +601,7 @@ class ActionMessage(Message):
 
         if self.__chat_messages is not None:
             res["chat_messages"] = self.__chat_messages
+            res["next_cursor"] = self.__next_cursor
 
         if self.__ext_key:
             res["extKey"] = self.__ext_key
@@ -0,0 +1,150 @@
+"""
+Фоновая обработка сообщений чата (перевод, push уведомления) вне обработчика событий сокета
+"""
+import os
+from collections import defaultdict
+from json import dumps
+from threading import Lock
+from time import monotonic, sleep
+from traceback import format_exc
+from typing import Callable, Dict
+
+import gevent
+from flask import Flask
+from gevent.queue import Queue, Full
+
+from configs import configs
+from logger import get_logger
+
+
+LOGGER = get_logger("ChatPipeline", "ChatPipeline")
+DEAD_LETTER = get_logger("ChatDeadLetter", "ChatDeadLetter")
+
+CHAT_CONFIG = configs.get('chat') or {}
+
+
+class StageMetrics:
+    """
+    Задержки стадий обработки в памяти процесса
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__data: Dict[str, dict] = defaultdict(lambda: {"count": 0, "failed": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+    def add(self, stage: str, duration: float, failed: bool = False):
+        duration_ms = duration * 1000
+        with self.__lock:
+            item = self.__data[stage]
+            item["count"] += 1
+            item["failed"] += int(failed)
+            item["total_ms"] += duration_ms
+            item["max_ms"] = max(item["max_ms"], duration_ms)
+
+    def to_list(self) -> list:
+        with self.__lock:
+            data = [{"stage": stage, **item} for stage, item in self.__data.items()]
+
+        for item in data:
+            item["avg_ms"] = round(item["total_ms"] / item["count"], 2) if item["count"] else 0.0
+            item["total_ms"] = round(item["total_ms"], 2)
+            item["max_ms"] = round(item["max_ms"], 2)
+
+        return data
+
+
+class ChatPipeline:
+    """
+    Ограниченный пул фоновых гринлетов с очередью задач. Стадии задачи выполняются с повторами,
+    после исчерпания повторов задача записывается в журнал необработанных (dead letter).
+    При переполнении очереди задача выполняется в вызывающем гринлете
+    """
+
+    def __init__(self, workers: int, queue_size: int, retries: int, backoff: float):
+        self.__workers_count = workers
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__queue = Queue(maxsize=queue_size)
+        self.__pid = None
+        self.__lock = Lock()
+        self.metrics = StageMetrics()
+
+    def __start(self):
+        # гринлеты запускаются в процессе воркера после fork
+        if self.__pid == os.getpid():
+            return
+
+        with self.__lock:
+            if self.__pid != os.getpid():
+                self.__queue = Queue(maxsize=self.__queue.maxsize)
+                for _ in range(self.__workers_count):
+                    gevent.spawn(self.__worker)
+                self.__pid = os.getpid()
+
+    def submit(self, app: Flask, func: Callable, *args):
+        """
+        Постановка задачи в очередь
+
+        :param app: приложение, в контексте которого выполняется задача
+        :param func: задача
+        :param args: аргументы задачи
+        """
+
+        self.__start()
+        item = (monotonic(), app, func, args)
+
+        try:
+            self.__queue.put_nowait(item)
+        except Full:
+            LOGGER.warning("Pipeline queue is full, running %s inline", func.__name__)
+            self.__execute(*item)
+
+    def __worker(self):
+        while True:
+            self.__execute(*self.__queue.get())
+
+    def __execute(self, enqueued: float, app: Flask, func: Callable, args: tuple):
+        self.metrics.add("queue", monotonic() - enqueued)
+        try:
+            with app.app_context():
+                func(*args)
+        except Exception as err:
+            LOGGER.error(f"Pipeline task {func.__name__} failed: {str(err)}\n{format_exc()}")
+
+    def run_stage(self, stage: str, func: Callable, *args, payload: dict = None) -> bool:
+        """
+        Выполнение стадии задачи с повторами и экспоненциальной задержкой между ними
+
+        :param stage: имя стадии для метрик и журнала
+        :param func: функция стадии
+        :param args: аргументы функции
+        :param payload: данные задачи для журнала необработанных
+        :return: стадия выполнена успешно
+        """
+
+        for attempt in range(self.__retries + 1):
+            started = monotonic()
+            try:
+                func(*args)
+            except Exception as err:
+                self.metrics.add(stage, monotonic() - started, failed=True)
+                if attempt < self.__retries:
+                    sleep(self.__backoff * 2 ** attempt)
+                    continue
+                DEAD_LETTER.error(dumps({"stage": stage,
+                                         "attempts": attempt + 1,
+                                         "error": f"{err.__class__.__name__}: {err}",
+                                         "payload": payload},
+                                        ensure_ascii=False, default=str))
+                return False
+            else:
+                self.metrics.add(stage, monotonic() - started)
+                return True
+
+        return False
+
+
+PIPELINE = ChatPipeline(workers=CHAT_CONFIG.get('pipeline_workers') or 20,
+                        queue_size=CHAT_CONFIG.get('pipeline_queue_size') or 1000,
+                        retries=3 if CHAT_CONFIG.get('pipeline_retries') is None else CHAT_CONFIG['pipeline_retries'],
+                        backoff=CHAT_CONFIG.get('pipeline_retry_backoff') or 0.5)
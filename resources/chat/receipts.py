@@ -0,0 +1,108 @@
+"""
+Квитанции о доставке и просмотре в виде отметки "до сообщения N в чате C" с объединением пачек событий
+"""
+from threading import Lock
+from traceback import format_exc
+from typing import Callable, Dict, Tuple
+
+import gevent
+from sqlalchemy import update
+
+from configs import configs
+from logger import get_logger
+from models.connection import session
+from models.models import ChatMessage
+from resources.chat.counters import UNREAD
+from resources.chat.utils import Actions, to_int
+
+
+LOGGER = get_logger("ChatReceipts", "ChatReceipts")
+
+
+class ReceiptCoalescer:
+    """
+    Отметки доставки/просмотра, пришедшие от пользователя по одному чату в пределах окна, сводятся к одной
+    отметке с максимальным идентификатором сообщения. По истечении окна отметка применяется одним
+    UPDATE по диапазону сообщений, второй участник получает одно событие
+    """
+
+    def __init__(self, window: float):
+        self.__window = window
+        self.__lock = Lock()
+        self.__pending: Dict[Tuple[str, int, int], int] = {}
+
+    def submit(self, action: Actions, chat_id, user_id, message_id, notify: Callable[[int, int, dict], None]):
+        """
+        Регистрация отметки
+
+        :param action: VIEWED или DELIVERED
+        :param chat_id: идентификатор чата
+        :param user_id: получатель сообщений, отметивший их
+        :param message_id: последнее доставленное/просмотренное сообщение
+        :param notify: отправка события участникам чата: (chat_id, user_id, данные события)
+        """
+
+        chat_id, message_id = to_int(chat_id), to_int(message_id)
+
+        if chat_id is None or message_id is None:
+            # некорректные данные сокета, отметка не применяется
+            LOGGER.warning(f"Отметка {action} пользователя {user_id} пропущена: некорректный чат или сообщение")
+            return
+
+        key = (Actions(action).value, chat_id, user_id)
+
+        with self.__lock:
+            if key in self.__pending:
+                self.__pending[key] = max(self.__pending[key], message_id)
+                return
+            self.__pending[key] = message_id
+
+        if self.__window:
+            gevent.spawn_later(self.__window, self.__flush, key, notify)
+        else:
+            self.__flush(key, notify)
+
+    def __flush(self, key: Tuple[str, int, int], notify: Callable[[int, int, dict], None]):
+        with self.__lock:
+            up_to = self.__pending.pop(key)
+
+        action, chat_id, user_id = key
+
+        try:
+            marked = apply_receipt(action, chat_id, user_id, up_to)
+            if marked:
+                notify(chat_id, user_id, {"action": action, "chat_id": chat_id, "message_id": up_to, "up_to": True})
+        except Exception as err:
+            LOGGER.error(f"Не удалось применить отметку {action} до {up_to} в чате {chat_id} "
+                         f"пользователя {user_id}: {str(err)}\n{format_exc()}")
+
+
+def apply_receipt(action: str, chat_id: int, user_id, up_to: int) -> int:
+    """
+    Отметка всех сообщений чата, полученных пользователем, до указанного включительно
+
+    :param action: VIEWED или DELIVERED (имя колонки)
+    :param chat_id: идентификатор чата
+    :param user_id: получатель сообщений
+    :param up_to: идентификатор последнего отмечаемого сообщения
+    :return: число отмеченных сообщений
+    """
+
+    column = getattr(ChatMessage, action)
+
+    with session() as ses:
+        marked = ses.execute(update(ChatMessage).
+                             where(ChatMessage.chat_id == chat_id,
+                                   ChatMessage.receiver == user_id,
+                                   ChatMessage.id <= up_to,
+                                   column.isnot(True)).
+                             values({action: True})).rowcount
+        ses.commit()
+
+    if marked and action == Actions.VIEWED.value:
+        UNREAD.decrement(user_id, chat_id, marked)
+
+    return marked
+
+
+RECEIPTS = ReceiptCoalescer((configs.get('chat') or {}).get('receipts_window', 0.5))
@@ -0,0 +1,104 @@
+"""
+Формат данных событий сокета, согласуемый с клиентом при подключении: JSON (по умолчанию) или msgpack
+"""
+from typing import Callable, Iterable
+
+import msgpack
+from flask import request
+
+from configs import configs
+from models.connection import get_redis_client
+from resources.chat.utils import user_room
+
+
+SOCKET_IO_CONFIG = configs.get('socket_io') or {}
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# msgpack доступен клиентам, только если включён в настройках
+SERIALIZERS = (JSON, MSGPACK) if SOCKET_IO_CONFIG.get('msgpack') else (JSON, )
+
+
+def negotiate_serializer() -> str:
+    """
+    Формат, запрошенный клиентом при подключении (параметр запроса или заголовок serializer)
+    """
+
+    serializer = request.args.get("serializer") or request.headers.get("serializer")
+
+    return serializer if serializer in SERIALIZERS else JSON
+
+
+def format_room(room: str, serializer: str) -> str:
+    """
+    Комната сокетов с указанным форматом данных, JSON клиенты остаются в исходной комнате
+    """
+
+    return room if serializer == JSON else f"{room}:{serializer}"
+
+
+def pack(data: dict) -> bytes:
+    """
+    Кодирование данных события в msgpack, отправляется клиенту бинарным вложением
+    """
+
+    return msgpack.packb(data, use_bin_type=True, default=str)
+
+
+class MsgpackSockets:
+    """
+    Число подключённых msgpack сокетов пользователей, общее для воркеров и узлов. По нему событие кодируется
+    и публикуется в msgpack комнаты только тех адресатов, у которых такие сокеты есть
+    """
+
+    KEY = "msgpack_sockets:{}"
+
+    def __init__(self, db: int = configs.get('redis').get('socket_db')):
+        self.__redis = get_redis_client(db)
+
+    def add(self, user_id):
+        # счётчик без срока жизни: сокеты, потерянные при аварийной остановке воркера, приводят только
+        # к лишней публикации msgpack пакета, истечение же оставило бы живой сокет без событий
+        self.__redis.incr(self.KEY.format(user_id))
+
+    def remove(self, user_id):
+        if self.__redis.decr(self.KEY.format(user_id)) <= 0:
+            self.__redis.delete(self.KEY.format(user_id))
+
+    def users(self, user_ids: list) -> list:
+        """
+        Адресаты, у которых есть msgpack сокеты
+        """
+
+        if not user_ids:
+            return []
+
+        counts = self.__redis.mget([self.KEY.format(user_id) for user_id in user_ids])
+
+        return [user_id for user_id, count in zip(user_ids, counts) if count and int(count) > 0]
+
+
+MSGPACK_SOCKETS = MsgpackSockets()
+
+
+def emit_formatted(emit: Callable, event: str, data: dict, user_ids: Iterable, rooms: Iterable[str] = (), **kwargs):
+    """
+    Отправка события устройствам пользователей: данные кодируются один раз для каждого формата,
+    msgpack пакет публикуется, только если у адресатов есть msgpack сокеты
+
+    :param emit: функция отправки (flask_socketio.emit или Namespace.emit)
+    :param event: имя события
+    :param data: данные события
+    :param user_ids: адресаты (комнаты пользователей)
+    :param rooms: дополнительные комнаты JSON клиентов (комната чата), msgpack сокеты адресатов получают
+                  событие через комнаты пользователей
+    """
+
+    user_ids = list(dict.fromkeys(user_ids))
+
+    emit(event, data, room=list(rooms) + [user_room(user_id) for user_id in user_ids], **kwargs)
+
+    if MSGPACK in SERIALIZERS and (msgpack_users := MSGPACK_SOCKETS.users(user_ids)):
+        emit(event, pack(data), room=[format_room(user_room(user_id), MSGPACK) for user_id in msgpack_users],
+             **kwargs)
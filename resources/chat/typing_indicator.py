@@ -0,0 +1,111 @@
+"""
+Индикатор набора текста: события TYPING/STOP_TYPING обрабатываются в памяти процесса без обращений к БД и Redis
+"""
+from threading import Lock
+from time import monotonic
+from traceback import format_exc
+from typing import Callable, Dict, Tuple
+
+import gevent
+
+from configs import configs
+from logger import get_logger
+from resources.chat.utils import Actions, to_int
+
+
+LOGGER = get_logger("ChatTyping", "ChatTyping")
+
+CHAT_CONFIG = configs.get('chat') or {}
+
+
+class TypingState:
+    __slots__ = ("emitted", "deadline")
+
+    def __init__(self, emitted: float, deadline: float):
+        self.emitted = emitted
+        self.deadline = deadline
+
+
+class TypingThrottle:
+    """
+    События набора текста пользователя в чате сводятся к одному событию TYPING за интервал.
+    Если новых событий нет дольше таймаута, участникам отправляется STOP_TYPING
+    """
+
+    def __init__(self, interval: float, timeout: float):
+        self.__interval = interval
+        self.__timeout = timeout
+        self.__lock = Lock()
+        self.__states: Dict[Tuple[int, object], TypingState] = {}
+
+    def typing(self, chat_id, user_id, notify: Callable[[int, object, Actions], None]):
+        """
+        Пользователь набирает текст
+
+        :param chat_id: идентификатор чата
+        :param user_id: идентификатор пользователя
+        :param notify: отправка события участникам чата: (chat_id, user_id, действие)
+        """
+
+        if (chat_id := to_int(chat_id)) is None:
+            # некорректные данные сокета, событие отбрасывается
+            return
+
+        key = (chat_id, user_id)
+        now = monotonic()
+
+        with self.__lock:
+            state = self.__states.get(key)
+            if state is None:
+                state = self.__states[key] = TypingState(emitted=now, deadline=now + self.__timeout)
+                gevent.spawn_later(self.__timeout, self.__expire, key, state, notify)
+                emit_now = True
+            else:
+                # таймер остановки переносится без создания нового гринлета
+                state.deadline = now + self.__timeout
+                emit_now = now - state.emitted >= self.__interval
+                if emit_now:
+                    state.emitted = now
+
+        if emit_now:
+            notify(key[0], user_id, Actions.TYPING)
+
+    def stop(self, chat_id, user_id, notify: Callable[[int, object, Actions], None]):
+        """
+        Пользователь закончил набор текста, событие отправляется, только если набор был объявлен
+
+        :param chat_id: идентификатор чата
+        :param user_id: идентификатор пользователя
+        :param notify: отправка события участникам чата: (chat_id, user_id, действие)
+        """
+
+        if (chat_id := to_int(chat_id)) is None:
+            return
+
+        with self.__lock:
+            state = self.__states.pop((chat_id, user_id), None)
+
+        if state:
+            notify(chat_id, user_id, Actions.STOP_TYPING)
+
+    def __expire(self, key: Tuple[int, object], state: TypingState, notify: Callable[[int, object, Actions], None]):
+        with self.__lock:
+            if self.__states.get(key) is not state:
+                # набор уже остановлен или начат заново
+                return
+
+            if (remaining := state.deadline - monotonic()) > 0:
+                gevent.spawn_later(remaining, self.__expire, key, state, notify)
+                return
+
+            del self.__states[key]
+
+        try:
+            notify(key[0], key[1], Actions.STOP_TYPING)
+        except Exception as err:
+            LOGGER.error(f"Не удалось отправить окончание набора в чате {key[0]} "
+                         f"пользователя {key[1]}: {str(err)}\n{format_exc()}")
+
+
+TYPING = TypingThrottle(interval=CHAT_CONFIG.get('typing_interval') or 2,
+                        timeout=CHAT_CONFIG.get('typing_timeout') or 6)
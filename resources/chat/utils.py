@@ -1,11 +1,16 @@
 from enum import Enum
-from typing import Tuple
+from hashlib import sha256
+from threading import Lock
+from typing import Tuple, Optional
+from unicodedata import normalize
 
 from google.cloud import translate_v2 as translate
 from sqlalchemy import func, and_
 from sqlalchemy.orm import aliased
 
+from configs import configs
 from models.models import ChatMessage, Users, AD, Currency, ChatMessageTranslated, UserXChat, Chat as ChatTable
+from resources.utils import TieredCache
 
 
 UserXChat2: UserXChat = aliased(UserXChat)
@@ -27,6 +32,124 @@ class Actions(str, Enum):
 class MessageType(str, Enum):
     MESSAGE = "message"
     ACTION = "action"
+    TRANSLATED = "translated"
+
+
+CHAT_CONFIG = configs.get('chat') or {}
+
+# кэш переводов: (хэш нормализованного текста, исходный язык, целевой язык) -> (перевод, исходный язык)
+TRANSLATIONS = TieredCache("translation",
+                           maxsize=CHAT_CONFIG.get('translation_cache_size') or 50000,
+                           ttl=CHAT_CONFIG.get('translation_cache_ttl') or 3600,
+                           redis_ttl=CHAT_CONFIG.get('translation_cache_redis_ttl') or 7 * 86400)
+# кэшируются только короткие фразы, длинные тексты практически не повторяются
+TRANSLATION_CACHE_MAX_LENGTH = CHAT_CONFIG.get('translation_cache_max_length') or 256
+
+
+class FakeTranslator:
+    """
+    Локальный переводчик для тестов и разработки, совместимый по интерфейсу с translate_v2.Client
+    """
+
+    def __init__(self, detected_language: str = 'en'):
+        self.detected_language = detected_language
+        self.calls = 0
+
+    def translate(self, text: str, target_language: str, source_language: str = None) -> dict:
+        self.calls += 1
+        return {"translatedText": f"[{target_language}] {text}",
+                "detectedSourceLanguage": source_language or self.detected_language}
+
+
+_TRANSLATOR = None
+_TRANSLATOR_LOCK = Lock()
+
+
+def to_int(value) -> Optional[int]:
+    """
+    Целое число из данных сокета (число или строка), None для отсутствующих и некорректных значений
+    """
+    if value is None or isinstance(value, bool):
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def user_room(user_id) -> str:
+    """
+    Комната всех сокетов пользователя
+    """
+    return f"user:{user_id}"
+
+
+def chat_room(chat_id) -> str:
+    """
+    Комната сокетов, открывших список чатов с этим чатом
+    """
+    return f"chat:{chat_id}"
+
+
+def get_translator():
+    """
+    Общий для процесса клиент переводчика
+    """
+
+    global _TRANSLATOR  # pylint: disable=global-statement
+
+    if _TRANSLATOR is None:
+        with _TRANSLATOR_LOCK:
+            if _TRANSLATOR is None:
+                _TRANSLATOR = FakeTranslator() if CHAT_CONFIG.get('fake_translator') else translate.Client()
+
+    return _TRANSLATOR
+
+
+def set_translator(translator):
+    """
+    Замена клиента переводчика (например, на FakeTranslator в тестах)
+
+    :param translator: объект с методом translate(text, target_language, source_language)
+    """
+
+    global _TRANSLATOR  # pylint: disable=global-statement
+
+    _TRANSLATOR = translator
+
+
+def translation_key(text: str, target: str, source: str = None) -> str:
+    """
+    Ключ кэша перевода: хэш текста с нормализованными юникодом и пробелами, исходный и целевой языки
+
+    :param text: исходный текст
+    :param target: целевой язык
+    :param source: исходный язык
+    """
+
+    normalized = " ".join(normalize("NFC", text).split())
+    digest = sha256(normalized.encode('utf-8')).hexdigest()
+
+    return f"{digest}:{source or 'auto'}:{target}"
+
+
+def peek_translation(text: str, target: str, source: str = None) -> Optional[str]:
+    """
+    Перевод из кэша без обращения к переводчику
+
+    :param text: исходный текст
+    :param target: целевой язык
+    :param source: исходный язык
+    :return: перевод или None, если его нет в кэше
+    """
+
+    if not text or len(text) > TRANSLATION_CACHE_MAX_LENGTH:
+        return None
+
+    cached = TRANSLATIONS.get(translation_key(text, target, source))
+
+    return None if cached is TRANSLATIONS.MISSING else cached[0]
 
 
 def translate_text(text: str, target: str, source: str = None) -> Tuple[str, str]:
@@ -40,11 +163,20 @@ def translate_text(text: str, target: str, source: str = None) -> Tuple[str, str
     :return: кортеж из переведённого текста и ISO кода детектированного языка исходного сообщения
     """
 
-    translate_client = translate.Client()
+    cacheable = len(text) <= TRANSLATION_CACHE_MAX_LENGTH
+
+    if cacheable:
+        key = translation_key(text, target, source)
+        if (cached := TRANSLATIONS.get(key)) is not TRANSLATIONS.MISSING:
+            return tuple(cached)
+
+    result = get_translator().translate(text, target_language=target, source_language=source)
+    translated = result["translatedText"], source or result["detectedSourceLanguage"]
 
-    result = translate_client.translate(text, target_language=target, source_language=source)
+    if cacheable:
+        TRANSLATIONS.set(key, translated)
 
-    return result["translatedText"], source or result["detectedSourceLanguage"]
+    return translated
 
 
 def get_chats_query(ses, user_id: int, chat_id: int = None):
@@ -2,9 +2,15 @@
 Модуль с общим функционалом пакета API ресурсов
 """
 from json import loads, dumps
+from threading import Lock
+from typing import Dict, Iterable, Callable, Any
+
+from cachetools import TTLCache
+from redis import WatchError
 
 from configs import configs
 from models.connection import get_redis_client
+from utils import SECONDS_PER_DAY
 
 
 class RedisDict(dict):
@@ -29,4 +35,168 @@ class RedisDict(dict):
 
     def get(self, key, default=None):
         res: str = self.__redis.get(key)
+        return self.decode(res, default)
+
+    @staticmethod
+    def decode(res, default=None):
+        """
+        Преобразование сырого значения Redis
+
+        :param res: значение из Redis
+        :param default: значение при отсутствии ключа
+        """
+
         return loads(res) if res else default
+
+    def modify(self, key, func: Callable[[Any], Any], default=None):
+        """
+        Атомарное изменение значения (оптимистическая блокировка WATCH/MULTI с повтором при конфликте)
+
+        :param key: ключ
+        :param func: функция, получающая текущее значение и возвращающая новое
+        :param default: текущее значение при отсутствии ключа
+        :return: новое значение
+        """
+
+        with self.__redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    value = func(self.decode(pipe.get(key), default))
+                    pipe.multi()
+                    pipe.set(key, dumps(value))
+                    pipe.execute()
+                    return value
+                except WatchError:
+                    continue
+
+
+class TieredCache:
+    """
+    Двухуровневый кэш: локальный LRU с ограниченным временем жизни в памяти процесса и общий для воркеров Redis.
+    Значения хранятся в Redis в JSON. Удаление ключа сбрасывает локальную копию только текущего процесса,
+    остальные воркеры увидят изменение по истечении локального ttl
+    """
+
+    MISSING = object()
+    # кэши процесса по префиксам, для вывода статистики
+    INSTANCES: Dict[str, 'TieredCache'] = {}
+
+    def __init__(self, prefix: str, maxsize: int = 10000, ttl: int = 60, redis_ttl: int = SECONDS_PER_DAY,
+                 db: int = configs.get('redis').get('cache_db')):
+        """
+        :param prefix: префикс ключей в Redis
+        :param maxsize: максимальное число ключей в памяти процесса
+        :param ttl: время жизни ключа в памяти процесса, сек
+        :param redis_ttl: время жизни ключа в Redis, сек
+        :param db: номер базы Redis
+        """
+
+        self.__prefix = prefix
+        self.__local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.__lock = Lock()
+        self.__redis = get_redis_client(db)
+        self.__redis_ttl = redis_ttl
+        self.__stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+        TieredCache.INSTANCES[prefix] = self
+
+    def _key(self, key) -> str:
+        return f"{self.__prefix}:{key}"
+
+    def get(self, key, default=MISSING):
+        """
+        Значение по ключу: из памяти процесса, затем из Redis
+
+        :param key: ключ
+        :param default: значение при отсутствии ключа
+        """
+
+        return self.get_many((key, )).get(key, default)
+
+    def get_many(self, keys: Iterable) -> dict:
+        """
+        Значения нескольких ключей, промахи локального уровня читаются из Redis одним запросом
+
+        :param keys: ключи
+        :return: словарь найденных значений
+        """
+
+        found = {}
+        missed = []
+
+        with self.__lock:
+            for key in keys:
+                value = self.__local.get(key, self.MISSING)
+                if value is self.MISSING:
+                    missed.append(key)
+                else:
+                    found[key] = value
+            self.__stats["local_hits"] += len(found)
+
+        if not missed:
+            return found
+
+        from_redis = {key: loads(res) for key, res in zip(missed, self.__redis.mget([self._key(k) for k in missed]))
+                      if res is not None}
+
+        with self.__lock:
+            self.__local.update(from_redis)
+            self.__stats["redis_hits"] += len(from_redis)
+            self.__stats["misses"] += len(missed) - len(from_redis)
+
+        found.update(from_redis)
+
+        return found
+
+    def set(self, key, value):
+        """
+        Запись значения на оба уровня
+
+        :param key: ключ
+        :param value: значение, сериализуемое в JSON
+        """
+
+        self.set_many({key: value})
+
+    def set_many(self, mapping: dict):
+        """
+        Запись нескольких значений на оба уровня, в Redis одним конвейером
+
+        :param mapping: ключи и значения
+        """
+
+        if not mapping:
+            return
+
+        with self.__lock:
+            self.__local.update(mapping)
+
+        pipe = self.__redis.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(self._key(key), dumps(value), ex=self.__redis_ttl)
+        pipe.execute()
+
+    def delete(self, key):
+        """
+        Удаление ключа с обоих уровней
+
+        :param key: ключ
+        """
+
+        with self.__lock:
+            self.__local.pop(key, None)
+
+        self.__redis.delete(self._key(key))
+
+    def stats(self) -> dict:
+        """
+        Счётчики попаданий процесса
+        """
+
+        with self.__lock:
+            stats = dict(self.__stats, local_size=len(self.__local))
+
+        total = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["local_hits"] + stats["redis_hits"]) / total, 4) if total else None
+
+        return stats
@@ -64,7 +64,7 @@ def validate_init_data(init_data: dict) -> bool:
     return new_hash == original_hash
 
 
-@with_session()
+@with_session(readonly=True)
 def get_user_from_token_sub(ses, user_id):
     """
     Получение пользователя из токена по TG_ID
@@ -0,0 +1,3 @@
+"""
+Служба состояния пользователей чата
+"""
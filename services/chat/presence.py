@@ -0,0 +1,225 @@
+"""
+Модуль присутствия пользователей в сети: состояние хранится в Redis с продлением по heartbeat и активности сокета,
+в PostgreSQL синхронизируется периодически пачками
+"""
+import os
+from threading import Lock
+from traceback import format_exc
+from typing import Callable, Optional
+
+import gevent
+from cachetools import TTLCache
+
+from configs import configs
+from logger import get_logger
+from models.connection import session, get_redis_client
+from models.models import Users
+
+
+LOGGER = get_logger("ChatPresence", "ChatPresence")
+
+CHAT_CONFIG = configs.get('chat') or {}
+
+
+class PresenceTracker:
+    """
+    Пользователь в сети, пока существует его ключ в Redis: событие ONLINE и любая активность сокета создают ключ
+    или продлевают его время жизни (heartbeat). Событие OFFLINE ставится в общую для воркеров очередь с задержкой:
+    ONLINE, обработанный любым воркером, отменяет его, и участники чатов ничего не получают.
+    Каждый воркер периодически забирает из Redis наступившие выходы из сети и истёкшие heartbeat, атомарный
+    скрипт отдаёт каждого пользователя только одному воркеру, который и уведомляет собеседников.
+    Изменённые пользователи накапливаются в множестве для пакетной синхронизации колонки online
+    """
+
+    KEY = "presence:{}"
+    DIRTY = "presence:dirty"
+    # время истечения heartbeat пользователей
+    EXPIRY = "presence:expiry"
+    # отложенные выходы из сети: время применения
+    OFFLINE_DUE = "presence:offline_due"
+
+    # время сценариев берётся из часов Redis, по ним же истекают ключи присутствия:
+    # расхождение часов воркеров и задержка сети не влияют на отметки очередей
+    __NOW = """
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    """
+
+    # heartbeat: 1, если пользователь перешёл в сеть
+    __ONLINE_SCRIPT = __NOW + """
+        local previous = redis.call('SET', KEYS[1], 1, 'EX', ARGV[1], 'GET')
+        redis.call('ZADD', KEYS[2], now + ARGV[1], ARGV[2])
+        redis.call('ZREM', KEYS[3], ARGV[2])
+        if not previous then
+            redis.call('SADD', KEYS[4], ARGV[2])
+            return 1
+        end
+        return 0
+    """
+
+    # отложенный выход из сети, повторное событие не переносит время применения
+    __OFFLINE_SCRIPT = __NOW + """
+        redis.call('ZADD', KEYS[1], 'NX', now + ARGV[1], ARGV[2])
+    """
+
+    # наступившие выходы из сети и истёкшие heartbeat: пользователи, перешедшие в офлайн
+    __SWEEP_SCRIPT = __NOW + """
+        local result = {}
+        local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[1])
+        for _, user in ipairs(due) do
+            redis.call('ZREM', KEYS[1], user)
+            redis.call('ZREM', KEYS[2], user)
+            if redis.call('DEL', ARGV[2] .. user) == 1 then
+                redis.call('SADD', KEYS[3], user)
+                table.insert(result, user)
+            end
+        end
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, ARGV[1])
+        for _, user in ipairs(expired) do
+            local pttl = redis.call('PTTL', ARGV[2] .. user)
+            if pttl == -2 then
+                redis.call('ZREM', KEYS[2], user)
+                redis.call('SADD', KEYS[3], user)
+                table.insert(result, user)
+            else
+                -- ключ ещё жив: пользователь остаётся в очереди до фактического истечения
+                redis.call('ZADD', KEYS[2], now + (pttl > 0 and pttl / 1000 or ARGV[3]), user)
+            end
+        end
+        return result
+    """
+
+    def __init__(self, ttl: int, debounce: float, sweep_interval: float, sweep_batch: int = 1000,
+                 db: int = configs.get('redis').get('socket_db')):
+        self.__redis = get_redis_client(db)
+        self.__ttl = ttl
+        self.__debounce = debounce
+        self.__sweep_interval = sweep_interval
+        self.__sweep_batch = sweep_batch
+        self.__online = self.__redis.register_script(self.__ONLINE_SCRIPT)
+        self.__offline = self.__redis.register_script(self.__OFFLINE_SCRIPT)
+        self.__sweep = self.__redis.register_script(self.__SWEEP_SCRIPT)
+        self.__lock = Lock()
+        self.__pid = None
+        self.__notify: Optional[Callable[[int, bool], None]] = None
+        # пользователи, присутствие которых недавно продлено этим процессом
+        self.__touched = TTLCache(maxsize=100000, ttl=ttl / 3)
+
+    def __start(self, notify: Callable[[int, bool], None]):
+        # гринлет проверки запускается в процессе воркера после fork
+        self.__notify = notify
+        if self.__pid == os.getpid():
+            return
+
+        with self.__lock:
+            if self.__pid != os.getpid():
+                self.__touched.clear()
+                gevent.spawn(self.__sweeper)
+                self.__pid = os.getpid()
+
+    def online(self, user_id, notify: Callable[[int, bool], None]):
+        """
+        Пользователь в сети (heartbeat), отменяет отложенный выход из сети
+
+        :param user_id: идентификатор пользователя
+        :param notify: уведомление участников чатов о смене состояния: (user_id, online)
+        """
+
+        self.__start(notify)
+
+        with self.__lock:
+            self.__touched[str(user_id)] = True
+
+        changed = self.__online(keys=[self.KEY.format(user_id), self.EXPIRY, self.OFFLINE_DUE, self.DIRTY],
+                                args=[self.__ttl, user_id])
+
+        if changed:
+            notify(user_id, True)
+
+    def touch(self, user_id, notify: Callable[[int, bool], None]):
+        """
+        Продление присутствия по активности сокета, не чаще одного раза за треть ttl в процессе
+
+        :param user_id: идентификатор пользователя
+        :param notify: уведомление участников чатов о смене состояния: (user_id, online)
+        """
+
+        with self.__lock:
+            touched = str(user_id) in self.__touched
+
+        if not touched:
+            self.online(user_id, notify)
+
+    def offline(self, user_id, notify: Callable[[int, bool], None]):
+        """
+        Пользователь вышел из сети, изменение применяется после задержки, если не придёт ONLINE
+
+        :param user_id: идентификатор пользователя
+        :param notify: уведомление участников чатов о смене состояния: (user_id, online)
+        """
+
+        self.__start(notify)
+
+        # активность сразу после OFFLINE (в том числе само событие) не отменяет выход
+        with self.__lock:
+            self.__touched[str(user_id)] = True
+
+        self.__offline(keys=[self.OFFLINE_DUE], args=[self.__debounce, user_id])
+
+    def __sweeper(self):
+        while True:
+            gevent.sleep(self.__sweep_interval)
+            try:
+                offline = self.__sweep(keys=[self.OFFLINE_DUE, self.EXPIRY, self.DIRTY],
+                                       args=[self.__sweep_batch, self.KEY.format(""), self.__ttl])
+            except Exception as err:
+                LOGGER.error(f"Не удалось проверить присутствие пользователей: {str(err)}\n{format_exc()}")
+                continue
+
+            for user_id in offline:
+                try:
+                    self.__notify(int(user_id) if user_id.isdigit() else user_id, False)
+                except Exception as err:
+                    LOGGER.error(f"Не удалось отправить выход пользователя {user_id} из сети: "
+                                 f"{str(err)}\n{format_exc()}")
+
+    def sync(self, batch_size: int = 1000) -> int:
+        """
+        Пакетная синхронизация колонки online в PostgreSQL: изменённые пользователи и пользователи,
+        чей heartbeat истёк
+
+        :param batch_size: число пользователей в одной пачке
+        :return: число синхронизированных пользователей
+        """
+
+        synced = 0
+
+        with session() as ses:
+            # истёкшие без события OFFLINE
+            online_in_db = [user_id for user_id, in ses.query(Users.user_id).filter(Users.online.is_(True))]
+            for i in range(0, len(online_in_db), batch_size):
+                batch = online_in_db[i:i + batch_size]
+                states = self.__redis.mget([self.KEY.format(user_id) for user_id in batch])
+                if expired := [user_id for user_id, state in zip(batch, states) if state is None]:
+                    self.__redis.sadd(self.DIRTY, *expired)
+
+            while user_ids := self.__redis.spop(self.DIRTY, batch_size):
+                states = self.__redis.mget([self.KEY.format(user_id) for user_id in user_ids])
+                online = [int(user_id) for user_id, state in zip(user_ids, states) if state is not None]
+                offline = [int(user_id) for user_id, state in zip(user_ids, states) if state is None]
+
+                if online:
+                    ses.query(Users).filter(Users.user_id.in_(online)).update({"online": True},
+                                                                               synchronize_session=False)
+                if offline:
+                    ses.query(Users).filter(Users.user_id.in_(offline)).update({"online": False},
+                                                                                synchronize_session=False)
+                ses.commit()
+                synced += len(user_ids)
+
+        return synced
+
+
+PRESENCE = PresenceTracker(ttl=CHAT_CONFIG.get('presence_ttl') or 90,
+                           debounce=CHAT_CONFIG.get('presence_debounce') or 5,
+                           sweep_interval=CHAT_CONFIG.get('presence_sweep_interval') or 1)
@@ -0,0 +1,13 @@
+"""
+Периодические задачи чата
+"""
+from main.celery import celery_app
+from services.chat.presence import PRESENCE
+
+
+@celery_app.task
+def sync_presence_task():
+    """
+    Пакетная синхронизация присутствия пользователей в PostgreSQL
+    """
+    return PRESENCE.sync()
@@ -73,7 +73,7 @@ def loader_post(ses, entity_id: str, files: list) -> Response:
     return make_response(jsonify({'files': file_list}), 200)
 
 
-@with_session()
+@with_session(readonly=True)
 def loader_get(ses, entity_id: str) -> Response:
     files = tuple(i.filename for i in ses.query(Documents.filename).filter_by(entity_id=entity_id))
 
@@ -91,7 +91,7 @@ def loader_delete(ses, entity_id: str, filename: str) -> Response:
     return make_response(jsonify({'message': 'Файл успешно удален'}), 200)
 
 
-@with_session()
+@with_session(readonly=True)
 def stories_get(ses, place_id: int = None) -> list:
 
     def transform(element):